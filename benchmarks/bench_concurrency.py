@@ -0,0 +1,139 @@
+# Concurrency stress test: many chats run the /newcontact conversation at the same time through a real
+# dispatcher with run_async handlers. Every chat only sends its next message after the bot answered the
+# previous one (plus a short think time), so the conversations of different chats interleave freely. Every
+# answer takes --api-latency seconds like a request to the Bot API, which the worker threads wait for in
+# parallel. Afterwards every chat must own exactly the contact it entered, otherwise conversation state leaked
+# between chats. Reports the update throughput for the given number of workers, which has to grow with the
+# workers: the steps of one conversation run one after another, those of different chats in parallel.
+#
+# usage: python benchmarks/bench_concurrency.py [--chats 200] [--workers 1 4 8] [--api-latency 0.01]
+import argparse
+import heapq
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import telegram
+from telegram.ext import Defaults, Dispatcher
+
+from bench_connections import load_bot_module
+
+
+class DispatcherBot:
+    """ stands in for telegram.Bot in a dispatcher and notifies the driver about every answer """
+
+    def __init__(self, on_reply, latency=0.0):
+        self.on_reply = on_reply
+        self.latency = latency
+        self.defaults = Defaults(run_async=True)
+        self.username = "stress_bot"
+        self.id = 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        self.on_reply(chat_id)
+
+
+def conversation_for(chat_id):
+    return ["/newcontact", "First{}".format(chat_id), "Last{}".format(chat_id), "12", "2021-01-01"]
+
+
+def make_update(bot, update_id, chat_id, text):
+    message = {"message_id": update_id, "date": int(time.time()), "text": text,
+               "chat": {"id": chat_id, "type": "private"},
+               "from": {"id": chat_id, "is_bot": False, "first_name": "user{}".format(chat_id)}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return telegram.Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def run(cr, chats, workers, think_time, api_latency):
+    steps = {chat_id: 0 for chat_id in range(1, chats + 1)}
+    pending = []
+    lock = threading.Condition()
+    done = threading.Event()
+
+    def on_reply(chat_id):
+        with lock:
+            steps[chat_id] += 1
+            if steps[chat_id] < len(conversation_for(chat_id)):
+                heapq.heappush(pending, (time.monotonic() + think_time, chat_id))
+                lock.notify()
+            elif all(step == len(conversation_for(chat)) for chat, step in steps.items()):
+                done.set()
+
+    bot = DispatcherBot(on_reply, api_latency)
+    update_queue = queue.Queue()
+    dispatcher = Dispatcher(bot, update_queue, workers=workers, use_context=True)
+    cr.add_handlers(dispatcher)
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+
+    start = time.monotonic()
+    update_id = 0
+    for chat_id in steps:
+        update_id += 1
+        update_queue.put(make_update(bot, update_id, chat_id, conversation_for(chat_id)[0]))
+    while not done.is_set():
+        with lock:
+            now = time.monotonic()
+            if not pending or pending[0][0] > now:
+                lock.wait(pending[0][0] - now if pending else 0.1)
+                continue
+            _, chat_id = heapq.heappop(pending)
+            step = steps[chat_id]
+        update_id += 1
+        update_queue.put(make_update(bot, update_id, chat_id, conversation_for(chat_id)[step]))
+    duration = time.monotonic() - start
+    dispatcher.stop()
+    thread.join()
+    return update_id, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="interleaved /newcontact conversations")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--think-time", type=float, default=0.005,
+                        help="seconds a chat waits after an answer before it sends its next message")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="seconds every answer of the bot takes")
+    parser.add_argument("--min-speedup", type=float, default=2.0,
+                        help="required ratio of the best throughput to the one with the fewest workers")
+    args = parser.parse_args()
+
+    throughput = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "bench.db"))
+        for workers in args.workers:
+            db = cr.db_pool.get()
+            cr.create_tables(db)
+            with db:
+                db.execute("DELETE FROM contacts")
+                db.execute("DELETE FROM users")
+                db.executemany("INSERT INTO users (chat_id, is_active, reminder_time, reminder_minute) "
+                               "VALUES (?,1,'08:00:00',480)", ((chat_id,) for chat_id in range(1, args.chats + 1)))
+            cr.user_cache = cr.UserCache(cr.USER_CACHE_SIZE)
+            updates, duration = run(cr, args.chats, workers, args.think_time, args.api_latency)
+            throughput[workers] = updates / duration
+            # every chat must own exactly the contact it entered
+            sql = """ SELECT users.chat_id, contacts.first_name, contacts.last_name, contacts.interval FROM users
+                      JOIN contacts ON contacts.user_id = users.user_id """
+            rows = db.execute(sql).fetchall()
+            corrupted = [row for row in rows
+                         if (row[1], row[2], row[3]) != ("First{}".format(row[0]), "Last{}".format(row[0]), 30)]
+            print("workers {:>2}: {} updates in {:.2f}s, {:.0f} updates/s, {} contacts, {} corrupted"
+                  .format(workers, updates, duration, updates / duration, len(rows), len(corrupted)))
+            if corrupted or len(rows) != args.chats:
+                sys.exit("conversation state leaked between chats")
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+    fewest = min(throughput)
+    if len(throughput) > 1 and max(throughput.values()) < args.min_speedup * throughput[fewest]:
+        sys.exit("the throughput does not grow with the workers, conversations of different chats are serialized")
+
+
+if __name__ == "__main__":
+    main()
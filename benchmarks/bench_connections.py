@@ -0,0 +1,124 @@
+# Compares handler latency with the pooled connections against the old behaviour of opening and
+# closing a connection for every update. The old behaviour is emulated by closing all pooled
+# connections after each handler call, so that the next call has to connect again. The user cache is cleared
+# before every call of the uncached variants, otherwise /start is answered from memory without touching the
+# database. The other variants start with every user in the cache, "start cached" shows the cache hit.
+#
+# usage: python benchmarks/bench_connections.py [--users 1000] [--contacts 20] [--runs 2000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+
+class StubBot:
+    """ stands in for telegram.Bot and simply counts the messages the handlers send """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+
+def write_conf(db_path, **settings):
+    """ write a throwaway configuration next to the database, further settings are given as keyword
+        arguments, e.g. SCHEDULER_MODE="bucketed"
+    :return: path of the configuration file
+    """
+    conf_path = os.path.join(os.path.dirname(db_path), "bench.conf")
+    settings = dict({"BOT_TOKEN": "123456:bench", "DB_FILENAME": db_path, "TIMEZONE": "Europe/Berlin"}, **settings)
+    with open(conf_path, "w") as conf_file:
+        for key, value in settings.items():
+            conf_file.write("{} = {!r}\n".format(key, value))
+    return conf_path
+
+
+def load_bot_module(db_path, **settings):
+    # contact_reminder reads its configuration on import, so write a throwaway one first
+    os.environ["CONTACT_REMINDER_CONF"] = write_conf(db_path, **settings)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    import contact_reminder
+    return contact_reminder
+
+
+def populate(cr, users, contacts):
+    """ register users with the given number of contacts each, filling reminder_minute and next_due like the
+        bot does. All contacts were last contacted long ago, so they are all due
+    """
+    db = cr.db_pool.get()
+    cr.create_tables(db)
+    with db:
+        db.executemany("INSERT INTO users (chat_id, is_active, reminder_time, reminder_minute) VALUES (?,?,?,?)",
+                       ((chat_id, 1, "08:00:00", cr.minute_of_day("08:00:00")) for chat_id in range(1, users + 1)))
+        db.executemany("INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due) "
+                       "VALUES (?,?,?,?,?,?)",
+                       (("First{}".format(ii), "Last{}".format(ii), 30, "2021_01_01", user_id,
+                         cr.due_day("2021_01_01", 30))
+                        for user_id in range(1, users + 1) for ii in range(contacts)))
+
+
+def time_handler(cr, call, runs, users, reconnect, cached=True):
+    if cached:
+        for chat_id in range(1, users + 1):
+            cr.lookup_user(chat_id)
+    durations = []
+    for run in range(runs):
+        chat_id = run % users + 1
+        if not cached:
+            cr.user_cache = cr.UserCache(cr.USER_CACHE_SIZE)
+        start = time.perf_counter()
+        call(chat_id)
+        durations.append(time.perf_counter() - start)
+        if reconnect:
+            cr.db_pool.close_all()
+            cr.db_read_pool.close_all()
+    durations.sort()
+    return {"mean_us": 1e6 * sum(durations) / len(durations),
+            "p50_us": 1e6 * durations[len(durations) // 2],
+            "p99_us": 1e6 * durations[int(len(durations) * 0.99)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pooled vs. per-update SQLite connections")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--contacts", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "bench.db"))
+        populate(cr, args.users, args.contacts)
+        bot = StubBot()
+
+        def update_for(chat_id, text=""):
+            return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=SimpleNamespace(text=text))
+
+        def start(chat_id):
+            cr.start(update_for(chat_id), SimpleNamespace(bot=bot))
+
+        # name, handler call and whether the user cache is kept between the calls
+        handlers = [
+            ("start", start, False),
+            ("start cached", start, True),
+            ("print_contacts", lambda chat_id: cr.print_contacts(update_for(chat_id), SimpleNamespace(bot=bot)),
+             True),
+            ("reminder", lambda chat_id: cr.reminder(SimpleNamespace(bot=bot, job=SimpleNamespace(context=chat_id))),
+             True),
+            ("last_contact_update", lambda chat_id: cr.last_contact_update(
+                update_for(chat_id, "I contacted First0 Last0 today!"), SimpleNamespace(bot=bot)), True),
+        ]
+        print("{:<22}{:>14}{:>14}{:>10}".format("handler", "before p50 us", "after p50 us", "speedup"))
+        for name, call, cached in handlers:
+            before = time_handler(cr, call, args.runs, args.users, reconnect=True, cached=cached)
+            after = time_handler(cr, call, args.runs, args.users, reconnect=False, cached=cached)
+            print("{:<22}{:>14.1f}{:>14.1f}{:>9.1f}x".format(name, before["p50_us"], after["p50_us"],
+                                                           before["p50_us"] / after["p50_us"]))
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Measures the latency of an interactive handler (print_contacts) while background threads keep the
+# database busy with last_contact_update writes and bucketed reminder scans, as during a reminder storm.
+# With all database work going through the DatabaseExecutor the handler latency should stay close to
+# its latency on an idle database.
+#
+# usage: python benchmarks/bench_executor.py [--users 2000] [--contacts 20] [--runs 500] [--load-threads 4]
+import argparse
+import os
+import random
+import tempfile
+import threading
+from types import SimpleNamespace
+
+from bench_connections import StubBot, load_bot_module, populate, time_handler
+
+
+def update_for(chat_id, text=""):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=SimpleNamespace(text=text))
+
+
+def load(cr, users, stop):
+    # alternates between one write per update and one scan over all users of the reminder bucket
+    bot = StubBot()
+    rng = random.Random()
+    while not stop.is_set():
+        chat_id = rng.randint(1, users)
+        try:
+            cr.last_contact_update(update_for(chat_id, "I contacted First0 Last0 today!"), SimpleNamespace(bot=bot))
+            cr.reminder_bucket(SimpleNamespace(bot=bot, job=SimpleNamespace(context=480)))
+        except cr.DatabaseBusy:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="handler latency while the database is under load")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--contacts", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--load-threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "bench.db"))
+        populate(cr, args.users, args.contacts)
+        db = cr.db_pool.get()
+        with db:
+            db.execute("UPDATE users SET reminder_minute = 480")
+            db.execute("UPDATE contacts SET next_due = 0")
+        # an empty cache makes every handler call look the user up in the database
+        cr.user_cache = cr.UserCache(0)
+        bot = StubBot()
+
+        def call(chat_id):
+            cr.print_contacts(update_for(chat_id), SimpleNamespace(bot=bot))
+
+        idle = time_handler(cr, call, args.runs, args.users, reconnect=False)
+        stop = threading.Event()
+        threads = [threading.Thread(target=load, args=(cr, args.users, stop), daemon=True)
+                   for _ in range(args.load_threads)]
+        for thread in threads:
+            thread.start()
+        loaded = time_handler(cr, call, args.runs, args.users, reconnect=False)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        cr.db_executor.shutdown()
+
+        print("{:<10}{:>12}{:>12}".format("", "p50 us", "p99 us"))
+        print("{:<10}{:>12.1f}{:>12.1f}".format("idle", idle["p50_us"], idle["p99_us"]))
+        print("{:<10}{:>12.1f}{:>12.1f}".format("loaded", loaded["p50_us"], loaded["p99_us"]))
+        print("executor: {reads} pending reads, {writes} pending writes, {rejected} rejected"
+              .format(**cr.db_executor.stats()))
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
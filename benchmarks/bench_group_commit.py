@@ -0,0 +1,117 @@
+# Write throughput of "I contacted X Y today!" with and without the LastContactBuffer. Every variant runs in a
+# fresh process against a new database: the users are registered with one contact each, then a number of
+# threads keep calling last_contact_update() for random users for a fixed time.
+#   direct    one UPDATE and commit per reply on the writer thread, as without LAST_CONTACT_BUFFER
+#   <n>ms     the replies are queued and committed in groups every n milliseconds or LAST_CONTACT_FLUSH_ROWS
+# The buffered variants are stopped before the time is taken, so the final commit counts. Reports the replies
+# per second, the p50/p99 latency of the handler, the commits and whether every replied contact was committed.
+# Defaults to synchronous FULL, where every commit waits for its fsync.
+#
+# usage: python benchmarks/bench_group_commit.py [--flush-ms 50 200] [--users 10000] [--threads 16] [--seconds 10]
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from bench_connections import StubBot, load_bot_module
+from bench_shards import populate
+
+
+def run_variant(flush_ms, db_dir, users, threads, seconds, synchronous, flush_rows, seed):
+    """ measure the reply throughput in this process, flush_ms 0 commits every reply on its own
+    :return: dict of results
+    """
+    cr = load_bot_module(os.path.join(db_dir, "group_commit.db"), DB_SYNCHRONOUS=synchronous,
+                         DB_MAX_PENDING=10 * threads)
+    cr.setup_logging(level="WARNING")
+    cr.create_all_tables()
+    populate(cr, users)
+    if flush_ms:
+        cr.last_contact_buffer = cr.LastContactBuffer(cr.db_shards, flush_interval=flush_ms / 1000,
+                                                      flush_rows=flush_rows)
+        cr.last_contact_buffer.start()
+    bot = StubBot()
+    latencies = [[] for _ in range(threads)]
+    replied = [set() for _ in range(threads)]
+    deadline = time.perf_counter() + seconds
+
+    def drive(index):
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            chat_id = rng.randint(1, users)
+            update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id),
+                                     message=SimpleNamespace(text="I contacted First0 Last0 today!"))
+            started = time.perf_counter()
+            cr.last_contact_update(update, SimpleNamespace(bot=bot))
+            latencies[index].append(time.perf_counter() - started)
+            replied[index].add(chat_id)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=drive, args=(ii,)) for ii in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stats = None
+    if cr.last_contact_buffer is not None:
+        cr.last_contact_buffer.stop()
+        stats = cr.last_contact_buffer.stats()
+    duration = time.perf_counter() - start
+    # every contact starts with next_due 0, so the replied ones are those with a later next_due
+    committed = cr.db_executor.query("SELECT count(*) FROM contacts WHERE next_due > 0").result()[0][0]
+    cr.close_databases()
+    durations = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    return {"variant": "{}ms".format(flush_ms) if flush_ms else "direct", "updates": len(durations),
+            "updates_per_second": len(durations) / duration,
+            "p50_ms": 1e3 * durations[len(durations) // 2], "p99_ms": 1e3 * durations[int(len(durations) * 0.99)],
+            "commits": stats["flushes"] if stats else len(durations),
+            "contacts_replied": len(set().union(*replied)), "contacts_committed": committed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reply throughput with the write-behind last contact buffer")
+    parser.add_argument("--flush-ms", type=int, nargs="+", default=[50, 200],
+                        help="LAST_CONTACT_FLUSH_MS of the buffered variants")
+    parser.add_argument("--flush-rows", type=int, default=500, help="LAST_CONTACT_FLUSH_ROWS")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent handler calls")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of every run")
+    parser.add_argument("--synchronous", default="FULL", help="DB_SYNCHRONOUS of the database")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run_variant(args.run, args.db_dir, args.users, args.threads, args.seconds,
+                                     args.synchronous, args.flush_rows, args.seed)))
+        return
+
+    results = []
+    for flush_ms in [0] + args.flush_ms:
+        with tempfile.TemporaryDirectory() as db_dir:
+            output = subprocess.check_output([sys.executable, os.path.realpath(__file__), "--run", str(flush_ms),
+                                              "--db-dir", db_dir, "--users", str(args.users),
+                                              "--threads", str(args.threads), "--seconds", str(args.seconds),
+                                              "--synchronous", args.synchronous, "--flush-rows", str(args.flush_rows),
+                                              "--seed", str(args.seed)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        results.append(result)
+        print("{:<7} {:>8} updates  {:>8.0f} updates/s  p50 {:>7.2f} ms  p99 {:>7.2f} ms  {:>7} commits  "
+              "{} of {} contacts committed".format(
+                  result["variant"], result["updates"], result["updates_per_second"], result["p50_ms"],
+                  result["p99_ms"], result["commits"], result["contacts_committed"], result["contacts_replied"]))
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
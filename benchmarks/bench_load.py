@@ -0,0 +1,263 @@
+# End-to-end load harness: runs the whole bot as a separate process against the local fake Bot API and
+# replays scripted traffic. Interactive chats register, add contacts with /newcontact and mark them as
+# contacted with "I contacted X Y today!", each chat sending its next message after the bot answered the
+# previous one. Meanwhile a reminder storm of pre-registered users fires at the start of the next minute.
+# Updates reach the bot through getUpdates or through its webhook listener. Reports update throughput,
+# p50/p99 handler latency (update sent until the bot's answer arrived) and reminder delivery lag. With
+# --metrics-output the bot's Prometheus metrics are scraped before it is stopped and written to that file.
+#
+# usage: python benchmarks/bench_load.py [--chats 100] [--contacts 3] [--storm 500] [--rate 30]
+#                                        [--source polling|webhook] [--scheduler bucketed|per_user|wheel]
+#                                        [--metrics-output metrics.txt]
+import argparse
+import collections
+import datetime
+import heapq
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytz
+
+from bench_connections import load_bot_module
+from fake_bot_api import FakeBotApi
+
+STORM_CHAT_OFFSET = 1000000
+
+
+def message_update(chat_id, text, message_id):
+    message = {"message_id": message_id, "date": int(time.time()), "text": text,
+               "chat": {"id": chat_id, "type": "private"},
+               "from": {"id": chat_id, "is_bot": False, "first_name": "user{}".format(chat_id)}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def script_for(contacts, reminder_time):
+    """ :return: list of (kind, text) which one interactive chat sends, every step is answered with one message
+    """
+    steps = [("register", "/register"), ("register", reminder_time)]
+    for ii in range(contacts):
+        # "soon" is no date, so the contact is due right away
+        steps += [("newcontact", "/newcontact"), ("newcontact", "First{}".format(ii)),
+                  ("newcontact", "Last{}".format(ii)), ("newcontact", "12"), ("newcontact", "soon")]
+    steps += [("contacted", "I contacted First{0} Last{0} today!".format(ii)) for ii in range(contacts)]
+    return steps
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), "p50": values[len(values) // 2], "p99": values[int(len(values) * 0.99)],
+            "max": values[-1]}
+
+
+class Driver:
+    """ sends the scripted steps of all interactive chats and records the answers of the bot """
+
+    def __init__(self, api, post_update, script, chats, storm, think_time):
+        self.post_update = post_update
+        self.script = script
+        self.think_time = think_time
+        self.steps = {chat_id: 0 for chat_id in range(1, chats + 1)}
+        self.sent_at = {}
+        self.latencies = collections.defaultdict(list)
+        self.storm_expected = storm
+        self.storm_delivered = {}
+        self.unexpected = 0
+        self._pending = []
+        self._message_id = 0
+        self._cond = threading.Condition()
+        api.on_message = self.on_message
+
+    def on_message(self, chat_id, text, sent_at):
+        with self._cond:
+            if chat_id >= STORM_CHAT_OFFSET:
+                self.storm_delivered.setdefault(chat_id, sent_at)
+            elif chat_id in self.sent_at:
+                step = self.steps[chat_id]
+                self.latencies[self.script[step][0]].append(sent_at - self.sent_at.pop(chat_id))
+                self.steps[chat_id] = step + 1
+                if step + 1 < len(self.script):
+                    heapq.heappush(self._pending, (time.monotonic() + self.think_time, chat_id))
+            else:
+                self.unexpected += 1
+            self._cond.notify_all()
+
+    def interactive_done(self):
+        return all(step == len(self.script) for step in self.steps.values())
+
+    def storm_done(self):
+        return len(self.storm_delivered) >= self.storm_expected
+
+    def run(self, deadline):
+        """ drive the interactive chats until their scripts are done and all reminders arrived
+        :return: seconds until the last interactive answer
+        """
+        start = time.monotonic()
+        interactive_duration = None
+        with self._cond:
+            for chat_id in self.steps:
+                heapq.heappush(self._pending, (start, chat_id))
+        while time.monotonic() < deadline:
+            with self._cond:
+                if interactive_duration is None and self.interactive_done():
+                    interactive_duration = time.monotonic() - start
+                if interactive_duration is not None and self.storm_done():
+                    break
+                now = time.monotonic()
+                if not self._pending or self._pending[0][0] > now:
+                    self._cond.wait(min(self._pending[0][0] - now if self._pending else 0.5, 0.5))
+                    continue
+                _, chat_id = heapq.heappop(self._pending)
+                self._message_id += 1
+                update = message_update(chat_id, self.script[self.steps[chat_id]][1], self._message_id)
+                self.sent_at[chat_id] = time.monotonic()
+            self.post_update(update)
+        return interactive_duration
+
+
+class WebhookPoster:
+    """ posts updates to the webhook listener of the bot over one keep-alive connection """
+
+    def __init__(self, port, path):
+        self.path = "/" + path
+        self.connection = http.client.HTTPConnection("127.0.0.1", port)
+        self.update_id = 0
+
+    def __call__(self, update):
+        self.update_id += 1
+        body = json.dumps(dict(update, update_id=self.update_id)).encode()
+        self.connection.request("POST", self.path, body=body, headers={"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError("webhook answered {}".format(response.status))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test against a fake Bot API")
+    parser.add_argument("--chats", type=int, default=100, help="interactive chats")
+    parser.add_argument("--contacts", type=int, default=3, help="contacts each interactive chat adds")
+    parser.add_argument("--storm", type=int, default=500, help="users reminded at the same minute")
+    parser.add_argument("--rate", type=int, default=30, help="OUTBOUND_GLOBAL_RATE of the bot")
+    parser.add_argument("--source", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--scheduler", choices=["bucketed", "per_user", "wheel"], default="bucketed")
+    parser.add_argument("--workers", type=int, default=4, help="dispatcher worker threads of the bot")
+    parser.add_argument("--think-time", type=float, default=0.01,
+                        help="seconds a chat waits after an answer before it sends its next message")
+    parser.add_argument("--margin", type=int, default=20, help="minimum seconds between start and storm")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--metrics-output", help="write the metrics of the bot to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        api = FakeBotApi().start()
+        port = free_port()
+        metrics_port = free_port()
+        db_path = os.path.join(tmp_dir, "load.db")
+        timezone = pytz.timezone("Europe/Berlin")
+        settings = {"BOT_API_URL": api.base_url, "SCHEDULER_MODE": args.scheduler, "SERVING_MODE": args.source,
+                    "DISPATCHER_WORKERS": args.workers, "OUTBOUND_GLOBAL_RATE": args.rate,
+                    "STATS_REPORT_INTERVAL": 0, "WEBHOOK_URL": "http://127.0.0.1:{}".format(port),
+                    "WEBHOOK_LISTEN": "127.0.0.1", "WEBHOOK_PORT": port, "WEBHOOK_PATH": "hook",
+                    "METRICS_PORT": metrics_port if args.metrics_output else 0}
+        cr = load_bot_module(db_path, **settings)
+
+        # the storm fires at the start of the first minute which leaves the bot enough time to start
+        now = datetime.datetime.now(timezone)
+        storm_at = (now + datetime.timedelta(seconds=args.margin + 60)).replace(second=0, microsecond=0)
+        storm_time = storm_at.strftime("%H:%M:%S")
+        storm_monotonic = time.monotonic() + (storm_at.timestamp() - time.time())
+        db = cr.db_pool.get()
+        cr.create_tables(db)
+        with db:
+            db.executemany("INSERT INTO users (user_id, chat_id, is_active, reminder_time, reminder_minute) "
+                           "VALUES (?,?,1,?,?)",
+                           ((ii, STORM_CHAT_OFFSET + ii, storm_time, cr.minute_of_day(storm_time))
+                            for ii in range(1, args.storm + 1)))
+            db.executemany("INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due) "
+                           "VALUES ('Storm', 'Contact', 30, '2021_01_01', ?, 0)",
+                           ((ii,) for ii in range(1, args.storm + 1)))
+        cr.db_executor.shutdown()
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+
+        # interactive chats choose a reminder time which has passed today, so they are not reminded
+        reminder_time = (now - datetime.timedelta(hours=1)).strftime("%H:%M:%S")
+        script = script_for(args.contacts, reminder_time)
+        log_path = os.path.join(tmp_dir, "bot.log")
+        with open(log_path, "w") as log_file:
+            bot = subprocess.Popen([sys.executable, os.path.realpath(cr.__file__)], stdout=log_file,
+                                   stderr=subprocess.STDOUT, env=dict(os.environ))
+        try:
+            if not api.wait_for_call("getUpdates" if args.source == "polling" else "setWebhook", timeout=60):
+                sys.exit("the bot did not start, see its output:\n" + open(log_path).read())
+            post_update = api.push_update if args.source == "polling" else WebhookPoster(port, "hook")
+            driver = Driver(api, post_update, script, args.chats, args.storm, args.think_time)
+            deadline = max(storm_monotonic, time.monotonic()) + args.storm / args.rate * 3 + 60
+            interactive_duration = driver.run(deadline)
+            if args.metrics_output:
+                connection = http.client.HTTPConnection("127.0.0.1", metrics_port)
+                connection.request("GET", "/metrics")
+                with open(args.metrics_output, "wb") as metrics_file:
+                    metrics_file.write(connection.getresponse().read())
+                connection.close()
+        finally:
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(60)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            api.stop()
+
+    updates = sum(len(latencies) for latencies in driver.latencies.values())
+    results = {"source": args.source, "scheduler": args.scheduler, "workers": args.workers, "chats": args.chats,
+               "updates": updates, "interactive_seconds": interactive_duration,
+               "throughput": updates / interactive_duration if interactive_duration else None,
+               "latency": {kind: percentiles(latencies) for kind, latencies in driver.latencies.items()},
+               "storm": {"expected": args.storm, "delivered": len(driver.storm_delivered), "rate": args.rate,
+                         "lag": percentiles([sent_at - storm_monotonic
+                                             for sent_at in driver.storm_delivered.values()])},
+               "unexpected_messages": driver.unexpected}
+    results["latency"]["all"] = percentiles([latency for latencies in driver.latencies.values()
+                                             for latency in latencies])
+
+    if interactive_duration is None:
+        print("interactive chats did not finish, {} updates answered".format(updates))
+    else:
+        print("{} updates answered in {:.2f}s, {:.0f} updates/s".format(updates, interactive_duration,
+                                                                      results["throughput"]))
+    for kind, stats in results["latency"].items():
+        if stats["count"]:
+            print("latency {:<11} p50 {:>8.2f} ms  p99 {:>8.2f} ms  max {:>8.2f} ms".format(
+                kind, 1e3 * stats["p50"], 1e3 * stats["p99"], 1e3 * stats["max"]))
+    lag = results["storm"]["lag"]
+    print("reminders delivered {} of {}".format(results["storm"]["delivered"], args.storm))
+    if lag["count"]:
+        print("reminder lag p50 {:.2f}s  p99 {:.2f}s  max {:.2f}s (rate budget {}/s)".format(
+            lag["p50"], lag["p99"], lag["max"], args.rate))
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if interactive_duration is None or results["storm"]["delivered"] < args.storm:
+        sys.exit("not all traffic was handled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Pushes a reminder storm through the OutboundQueue against the local fake Bot API and reports
+# delivery throughput, retries and whether the global and per chat rate budgets were respected. Then it
+# queues a backlog of --backlog messages for a stubbed bot and measures the CPU time the sender thread uses
+# while the rate budget holds the backlog back, and the latency of queueing one more message.
+#
+# usage: python benchmarks/bench_outbound.py [--chats 200] [--messages 2] [--rate 25] [--flood-every 50]
+#                                            [--backlog 100000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import telegram
+
+from bench_connections import load_bot_module
+from fake_bot_api import FakeBotApi
+
+
+class NullBot:
+    """ stands in for telegram.Bot and sends nothing """
+
+    def send_message(self, chat_id, **kwargs):
+        pass
+
+
+def measure_backlog(cr, backlog, rate, seconds=3.0):
+    """ :return: CPU seconds used while the backlog waits and the largest latency of send_message in ms
+    """
+    queue = cr.OutboundQueue(NullBot(), global_rate=rate, chat_interval=1.0)
+    queue.start()
+    for chat_id in range(backlog):
+        queue.send_message(chat_id, text="backlog")
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    latencies = []
+    for chat_id in range(backlog, backlog + 100):
+        start = time.perf_counter()
+        queue.send_message(chat_id, text="backlog")
+        latencies.append(time.perf_counter() - start)
+    return cpu, 1e3 * max(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="outbound queue against a fake Bot API")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=2, help="messages per chat")
+    parser.add_argument("--rate", type=int, default=25, help="global messages per second")
+    parser.add_argument("--chat-interval", type=float, default=1.0)
+    parser.add_argument("--flood-every", type=int, default=50, help="answer every n-th call with 429")
+    parser.add_argument("--backlog", type=int, default=100000, help="queued messages of the backlog check")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "bench.db"))
+        api = FakeBotApi(flood_every=args.flood_every, retry_after=1).start()
+        bot = telegram.Bot("123456:bench", base_url=api.base_url)
+        queue = cr.OutboundQueue(bot, global_rate=args.rate, chat_interval=args.chat_interval)
+        queue.start()
+        start = time.monotonic()
+        for ii in range(args.messages):
+            for chat_id in range(1, args.chats + 1):
+                queue.send_message(chat_id, text="reminder {}".format(ii))
+        queue.stop()
+        duration = time.monotonic() - start
+        api.stop()
+        backlog_cpu, enqueue_ms = measure_backlog(cr, args.backlog, args.rate)
+
+    times = sorted(message["time"] for message in api.sent)
+    # largest number of messages delivered within any one second
+    peak, left = 0, 0
+    for right in range(len(times)):
+        while times[right] - times[left] >= 1:
+            left += 1
+        peak = max(peak, right - left + 1)
+    min_gap = min((b["time"] - a["time"]
+                   for chat_id in range(1, args.chats + 1)
+                   for a, b in zip(api.messages_for(chat_id), api.messages_for(chat_id)[1:])), default=None)
+    stats = queue.stats()
+    print("delivered {} of {} messages in {:.1f}s ({:.1f}/s)".format(len(api.sent), args.chats * args.messages,
+                                                                   duration, len(api.sent) / duration))
+    print("429 answers {}, retries {}, failed {}".format(api.rejected, stats["retried"], stats["failed"]))
+    print("peak messages per second {} (budget {})".format(peak, args.rate))
+    if min_gap is not None:
+        print("smallest gap between two messages to one chat {:.2f}s (budget {}s)".format(min_gap, args.chat_interval))
+    print("backlog of {}: {:.3f} CPU-s in 3s, send_message max {:.2f} ms".format(args.backlog, backlog_cpu,
+                                                                                enqueue_ms))
+    if len(api.sent) != args.chats * args.messages:
+        sys.exit("messages were lost")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Peak-window benchmark of the bucketed reminder: all users share one reminder minute and every one of them has
+# due contacts. Times reminder_bucket() computing the due lists in the bot process and on reminder pools of
+# the given sizes (REMINDER_PROCESSES), against a stubbed bot, so the sending itself costs next to nothing.
+# The speedup is bounded by the number of cores of the machine, which is printed first. Finally a pool which was
+# shut down has to fall back to the bot process and still send every reminder.
+#
+# usage: python benchmarks/bench_reminder_pool.py [--users 100000] [--contacts 5] [--processes 1 2 4] [--runs 3]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from bench_connections import StubBot, load_bot_module
+
+
+def populate(cr, users, contacts):
+    db = cr.db_pool.get()
+    cr.create_tables(db)
+    with db:
+        db.executemany("INSERT INTO users (user_id, chat_id, is_active, reminder_time, reminder_minute) "
+                       "VALUES (?,?,1,'08:00:00',480)", ((user_id, user_id) for user_id in range(1, users + 1)))
+        db.executemany("INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due) "
+                       "VALUES (?,?,30,'2021_01_01',?,0)",
+                       (("First{}".format(ii), "Last{}".format(ii), user_id)
+                        for user_id in range(1, users + 1) for ii in range(contacts)))
+
+
+def time_bucket(cr, runs):
+    bot = StubBot()
+    context = SimpleNamespace(bot=bot, job=SimpleNamespace(context=480))
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        cr.reminder_bucket(context)
+        durations.append(time.perf_counter() - start)
+    return {"seconds": min(durations), "reminders": bot.sent // runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bucketed reminders computed in worker processes")
+    parser.add_argument("--users", type=int, default=100000, help="users in the reminder minute")
+    parser.add_argument("--contacts", type=int, default=5, help="due contacts per user")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="pool sizes to compare")
+    parser.add_argument("--runs", type=int, default=3, help="runs per configuration, the fastest one counts")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    print("{} cores".format(os.cpu_count()))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "pool.db"), SCHEDULER_MODE="bucketed")
+        populate(cr, args.users, args.contacts)
+        for processes in [0] + args.processes:
+            cr.REMINDER_PROCESSES = processes
+            cr.reminder_pool = cr.start_reminder_pool(processes) if processes else None
+            result = dict(time_bucket(cr, args.runs), processes=processes)
+            if cr.reminder_pool is not None:
+                cr.reminder_pool.shutdown()
+            results.append(result)
+            print("{:>2} processes  {:>8} reminders  {:>8.2f}s  {:>8.0f} users/s  speedup {:.2f}".format(
+                processes, result["reminders"], result["seconds"], args.users / result["seconds"],
+                results[0]["seconds"] / result["seconds"]))
+        cr.REMINDER_PROCESSES = max(args.processes)
+        cr.reminder_pool = cr.start_reminder_pool(cr.REMINDER_PROCESSES)
+        cr.reminder_pool.shutdown()
+        fallback = time_bucket(cr, 1)
+        print("broken pool  {:>8} reminders  {:>8.2f}s, pool {}".format(
+            fallback["reminders"], fallback["seconds"], "given up" if cr.reminder_pool is None else "kept"))
+        cr.close_databases()
+    if fallback["reminders"] != results[0]["reminders"] or cr.reminder_pool is not None:
+        sys.exit("a broken reminder pool did not fall back to the bot process")
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
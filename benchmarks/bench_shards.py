@@ -0,0 +1,109 @@
+# Write throughput with the users spread over 1, 2, 4, ... SQLite shards. Every shard count runs in a fresh
+# process (the shards are fixed when contact_reminder is imported): the users are registered with one contact
+# each, then a number of threads keep answering "I contacted X Y today!" through last_contact_update() for a
+# fixed time, i.e. one UPDATE and commit per call on the writer thread of the chat's shard. Reports the
+# committed updates per second and the p50/p99 latency of the handler. Use --synchronous FULL to make every
+# commit wait for its fsync.
+#
+# usage: python benchmarks/bench_shards.py [--shards 1 2 4] [--users 10000] [--threads 16] [--seconds 10]
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from bench_connections import StubBot, load_bot_module
+
+
+def populate(cr, users):
+    by_shard = {}
+    for chat_id in range(1, users + 1):
+        by_shard.setdefault(cr.shard_index(chat_id, cr.DB_SHARDS), []).append(chat_id)
+
+    def insert(db, chat_ids):
+        db.executemany("INSERT INTO users (chat_id, is_active, reminder_time, reminder_minute) VALUES (?,1,?,?)",
+                       ((chat_id, "08:00:00", 480) for chat_id in chat_ids))
+        db.execute("INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due) "
+                   "SELECT 'First0', 'Last0', 30, '2021_01_01', user_id, 0 FROM users")
+
+    for shard, chat_ids in by_shard.items():
+        cr.db_shards[shard].write(insert, chat_ids).result()
+
+
+def run_shards(shards, db_dir, users, threads, seconds, synchronous, seed):
+    """ measure the write throughput with the given number of shards in this process
+    :return: dict of results
+    """
+    cr = load_bot_module(os.path.join(db_dir, "shards.db"), DB_SHARDS=shards, DB_SYNCHRONOUS=synchronous,
+                         DB_MAX_PENDING=10 * threads)
+    cr.setup_logging(level="WARNING")
+    cr.create_all_tables()
+    populate(cr, users)
+    bot = StubBot()
+    latencies = [[] for _ in range(threads)]
+    deadline = time.perf_counter() + seconds
+
+    def drive(index):
+        rng = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            chat_id = rng.randint(1, users)
+            update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id),
+                                     message=SimpleNamespace(text="I contacted First0 Last0 today!"))
+            started = time.perf_counter()
+            cr.last_contact_update(update, SimpleNamespace(bot=bot))
+            latencies[index].append(time.perf_counter() - started)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=drive, args=(ii,)) for ii in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - start
+    cr.close_databases()
+    durations = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    return {"shards": shards, "updates": len(durations), "updates_per_second": len(durations) / duration,
+            "p50_ms": 1e3 * durations[len(durations) // 2], "p99_ms": 1e3 * durations[int(len(durations) * 0.99)]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write throughput with a sharded database")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="numbers of shards to compare")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent handler calls")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of every run")
+    parser.add_argument("--synchronous", default="NORMAL", help="DB_SYNCHRONOUS of the shards")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_shards(args.run, args.db_dir, args.users, args.threads, args.seconds, args.synchronous,
+                                    args.seed)))
+        return
+
+    results = []
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as db_dir:
+            output = subprocess.check_output([sys.executable, os.path.realpath(__file__), "--run", str(shards),
+                                              "--db-dir", db_dir, "--users", str(args.users),
+                                              "--threads", str(args.threads), "--seconds", str(args.seconds),
+                                              "--synchronous", args.synchronous, "--seed", str(args.seed)])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        results.append(result)
+        print("{:>3} shards  {:>8} updates  {:>8.0f} updates/s  p50 {:>7.2f} ms  p99 {:>7.2f} ms".format(
+            shards, result["updates"], result["updates_per_second"], result["p50_ms"], result["p99_ms"]))
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
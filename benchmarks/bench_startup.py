@@ -0,0 +1,157 @@
+# Startup benchmark for large users tables. Every variant runs in a fresh process against a copy of a generated
+# database, so that its memory is measured on its own:
+#   legacy    the former startup loop, which fetched all users at once and called pytz.timezone() and
+#             strptime() for every user before the bot started serving
+#   per_user  schedule_all_reminders() streaming the users in batches, one job per user
+#   bucketed  schedule_all_reminders() with one job per minute of the day
+#   wheel     schedule_all_reminders() with one ReminderWheel entry per user and a single driver job
+# For the streaming variants the loading runs on the background thread of start_scheduling_reminders() while
+# the main thread answers /printcontacts, as the bot does after startup. Reports the time until the first
+# answer, the latency of the answers while the reminders are being scheduled, the time until all jobs exist
+# and the growth of the resident memory, in total and per scheduled user.
+#
+# usage: python benchmarks/bench_startup.py [--users 1000000] [--variants legacy per_user bucketed wheel]
+import argparse
+import datetime
+import json
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from telegram.ext import Dispatcher, JobQueue
+
+from bench_concurrency import DispatcherBot
+from bench_connections import StubBot, load_bot_module
+from bench_suite import generate, summarize
+
+
+def rss_bytes():
+    """ :return: resident memory of this process in bytes, None where /proc is not available """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def legacy_schedule_all_reminders(cr, job_queue):
+    """ startup loop as it was before the users were streamed """
+    import pytz
+    cur = cr.db_read_pool.get().cursor()
+    cur.execute(''' SELECT chat_id, is_active, reminder_time FROM users''')
+    for row in cur.fetchall():
+        localtz = pytz.timezone(cr.TIMEZONE)
+        reminder_datetime = datetime.datetime.strptime(row[2], '%H:%M:%S').time()
+        reminder_datetime_tz = reminder_datetime.replace(tzinfo=localtz)
+        cr.jobs[row[0]] = job_queue.run_daily(cr.reminder, time=reminder_datetime_tz, context=row[0],
+                                              name=str(row[0]))
+        if row[1] == 0:
+            cr.jobs[row[0]].enabled = False
+
+
+def run_variant(variant, db_path, users, seed):
+    """ time the startup of one variant in this process
+    :return: dict of results
+    """
+    cr = load_bot_module(db_path, SCHEDULER_MODE="per_user" if variant == "legacy" else variant,
+                         STATS_REPORT_INTERVAL=0)
+    cr.setup_logging(level="WARNING")
+    cr.create_tables(cr.db_pool.get())
+    # a started but paused scheduler, so that the jobs are added as in the running bot but none of them fires
+    job_queue = JobQueue()
+    job_queue.set_dispatcher(Dispatcher(DispatcherBot(lambda chat_id: None), queue.Queue(), workers=0,
+                                        use_context=True))
+    job_queue.scheduler.start(paused=True)
+    bot = StubBot()
+    rng = random.Random(seed)
+    rss_before = rss_bytes()
+
+    def answer():
+        chat_id = rng.randint(1, users)
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=SimpleNamespace(text=""))
+        started = time.perf_counter()
+        cr.print_contacts(update, SimpleNamespace(bot=bot))
+        return time.perf_counter() - started
+
+    start = time.perf_counter()
+    if variant == "legacy":
+        legacy_schedule_all_reminders(cr, job_queue)
+        first_answer = time.perf_counter() - start + answer()
+        latencies = [answer() for _ in range(100)]
+        scheduled = time.perf_counter() - start
+    else:
+        thread = cr.start_scheduling_reminders(job_queue)
+        first_answer = time.perf_counter() - start + answer()
+        latencies = []
+        while thread.is_alive():
+            latencies.append(answer())
+            time.sleep(0.01)
+        scheduled = time.perf_counter() - start
+    rss_after = rss_bytes()
+    jobs = len(cr.jobs) + len(cr.bucket_jobs) + len(cr.reminder_wheel)
+    job_queue.scheduler.shutdown(wait=False)
+    cr.db_executor.shutdown()
+    return {"variant": variant, "users": users, "jobs": jobs, "first_answer_s": first_answer,
+            "scheduled_s": scheduled, "answers_while_loading": summarize(latencies) if latencies else None,
+            "rss_growth_mb": (rss_after - rss_before) / 2 ** 20 if rss_before is not None else None,
+            "rss_bytes_per_user": (rss_after - rss_before) / users if rss_before is not None else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="startup time and memory with a large users table")
+    parser.add_argument("--users", type=int, default=1000000, help="number of users")
+    parser.add_argument("--variants", nargs="+", choices=["legacy", "per_user", "bucketed", "wheel"],
+                        default=["legacy", "per_user", "bucketed", "wheel"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "contact_reminder_bench"),
+                        help="directory in which the generated databases are kept")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--run", choices=["legacy", "per_user", "bucketed", "wheel"], help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_variant(args.run, args.db, args.users, args.seed)))
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    # the same databases as bench_suite.py with one contact per user
+    source_path = os.path.join(args.data_dir, "users{}_contacts1_seed{}.db".format(args.users, args.seed))
+    if not os.path.exists(source_path):
+        print("generating {} users".format(args.users))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cr = load_bot_module(os.path.join(tmp_dir, "generate.db"))
+            generate(cr, source_path + ".tmp", args.users, 1, args.seed)
+        os.replace(source_path + ".tmp", source_path)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for variant in args.variants:
+            db_path = os.path.join(tmp_dir, "startup.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+            shutil.copyfile(source_path, db_path)
+            output = subprocess.check_output([sys.executable, os.path.realpath(__file__), "--run", variant,
+                                              "--db", db_path, "--users", str(args.users),
+                                              "--seed", str(args.seed)])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            results.append(result)
+            answers = result["answers_while_loading"]
+            print("{:<9} {:>8} jobs  first answer {:>8.3f}s  scheduled {:>8.2f}s  answer p50 {:>8.1f} us  "
+                  "p99 {:>8.1f} us  rss +{:.0f} MB ({:.0f} B/user)".format(
+                      variant, result["jobs"], result["first_answer_s"], result["scheduled_s"], answers["p50_us"],
+                      answers["p99_us"], result["rss_growth_mb"] or 0, result["rss_bytes_per_user"] or 0))
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
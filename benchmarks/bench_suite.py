@@ -0,0 +1,198 @@
+# Reproducible microbenchmark suite for the database handlers. For every size it generates a synthetic
+# database with the initial schema (cached in --data-dir, so later runs skip the generation), times the
+# migration in create_tables() and then reminder(), last_contact_update(), print_contacts(), reminder_bucket()
+# and the startup job loading of the --modes scheduler modes against a stubbed bot. per_user is left out by
+# default, its one job per user takes several gigabytes and minutes at a million users. The results are
+# written as JSON, and --compare prints the change of the p50 latencies against the results of an earlier
+# run, e.g. of another commit.
+#
+# usage: python benchmarks/bench_suite.py [--sizes 1000 100000 1000000] [--contacts 5] [--runs 1000]
+#                                         [--modes per_user bucketed wheel]
+#                                         [--output results.json] [--compare old_results.json]
+import argparse
+import datetime
+import json
+import os
+import platform
+import queue
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+from telegram.ext import Dispatcher, JobQueue
+
+from bench_concurrency import DispatcherBot
+from bench_connections import StubBot, load_bot_module
+
+INTERVALS = (7, 14, 30, 61, 91, 182, 365)
+
+
+def generate(cr, path, users, contacts, seed):
+    """ write a database with the initial schema (version 1) and random users and contacts """
+    rng = random.Random(seed)
+    today = datetime.date.today().toordinal()
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    for sql in cr.MIGRATIONS[0]:
+        db.execute(sql)
+    db.execute("PRAGMA user_version = 1")
+    with db:
+        # reminder times are spread over the minutes of the day, one in ten users is inactive
+        db.executemany("INSERT INTO users (user_id, chat_id, is_active, reminder_time) VALUES (?,?,?,?)",
+                       ((user_id, user_id, int(rng.random() >= 0.1),
+                         "{:02d}:{:02d}:00".format(rng.randrange(24), rng.randrange(60)))
+                        for user_id in range(1, users + 1)))
+        db.executemany("INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id) "
+                       "VALUES (?,?,?,?,?)",
+                       (("First{}".format(ii), "Last{}".format(ii), rng.choice(INTERVALS),
+                         datetime.date.fromordinal(today - rng.randrange(400)).strftime("%Y_%m_%d"), user_id)
+                        for user_id in range(1, users + 1) for ii in range(contacts)))
+    db.close()
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {"runs": len(durations),
+            "mean_us": 1e6 * sum(durations) / len(durations),
+            "p50_us": 1e6 * durations[len(durations) // 2],
+            "p99_us": 1e6 * durations[int(len(durations) * 0.99)]}
+
+
+def time_calls(call, args):
+    durations = []
+    for arg in args:
+        start = time.perf_counter()
+        call(arg)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def time_once(call):
+    start = time.perf_counter()
+    call()
+    return summarize([time.perf_counter() - start])
+
+
+def time_startup(cr, mode):
+    # a job queue which is bound to a dispatcher but not started, as in main() before polling begins
+    job_queue = JobQueue()
+    job_queue.set_dispatcher(Dispatcher(DispatcherBot(lambda chat_id: None), queue.Queue(), workers=0,
+                                        use_context=True))
+    cr.SCHEDULER_MODE = mode
+    cr.jobs.clear()
+    cr.bucket_jobs.clear()
+    cr.reminder_wheel = cr.ReminderWheel()
+    result = time_once(lambda: cr.schedule_all_reminders(job_queue))
+    result["jobs"] = len(cr.jobs) + len(cr.bucket_jobs) + len(cr.reminder_wheel)
+    cr.jobs.clear()
+    cr.bucket_jobs.clear()
+    cr.reminder_wheel = cr.ReminderWheel()
+    return result
+
+
+def run_size(cr, work_path, source_path, users, runs, seed, modes):
+    cr.db_pool.close_all()
+    cr.db_read_pool.close_all()
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(work_path + suffix):
+            os.remove(work_path + suffix)
+    shutil.copyfile(source_path, work_path)
+    # the caches and the day of due_today belong to the previous database, so every size starts without them
+    cr.user_cache = cr.UserCache(cr.USER_CACHE_SIZE)
+    cr.due_lists = cr.DueLists(cr.DUE_LIST_CACHE_SIZE)
+    cr.due_today_day = None
+    bot = StubBot()
+    rng = random.Random(seed)
+    chat_ids = [rng.randint(1, users) for _ in range(runs)]
+
+    def update_for(chat_id, text=""):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=SimpleNamespace(text=text))
+
+    results = {"create_tables_migrate": time_once(lambda: cr.create_tables(cr.db_pool.get())),
+               "create_tables": time_calls(lambda _: cr.create_tables(cr.db_pool.get()), range(min(runs, 100))),
+               "reminder": time_calls(lambda chat_id: cr.reminder(
+                   SimpleNamespace(bot=bot, job=SimpleNamespace(context=chat_id))), chat_ids),
+               "print_contacts": time_calls(lambda chat_id: cr.print_contacts(
+                   update_for(chat_id), SimpleNamespace(bot=bot)), chat_ids),
+               "last_contact_update": time_calls(lambda chat_id: cr.last_contact_update(
+                   update_for(chat_id, "I contacted First0 Last0 today!"), SimpleNamespace(bot=bot)), chat_ids),
+               "reminder_bucket": time_calls(lambda minute: cr.reminder_bucket(
+                   SimpleNamespace(bot=bot, job=SimpleNamespace(context=minute))),
+                   [rng.randrange(24 * 60) for _ in range(min(runs, 100))])}
+    for mode in modes:
+        results["startup_" + mode] = time_startup(cr, mode)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results):
+    print("\n{:<10}{:<24}{:>14}{:>14}{:>10}".format("users", "benchmark", "old p50 us", "new p50 us", "change"))
+    for size, benchmarks in results["results"].items():
+        for name, result in benchmarks.items():
+            old = old_results["results"].get(size, {}).get(name)
+            if old is None:
+                continue
+            print("{:<10}{:<24}{:>14.1f}{:>14.1f}{:>+9.1%}".format(size, name, old["p50_us"], result["p50_us"],
+                                                                  result["p50_us"] / old["p50_us"] - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="microbenchmarks of the database handlers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="numbers of users")
+    parser.add_argument("--contacts", type=int, default=5, help="contacts per user")
+    parser.add_argument("--runs", type=int, default=1000, help="calls per handler")
+    parser.add_argument("--modes", nargs="+", choices=["per_user", "bucketed", "wheel"],
+                        default=["bucketed", "wheel"], help="scheduler modes whose startup is timed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "contact_reminder_bench"),
+                        help="directory in which the generated databases are kept")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {"commit": git_commit(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+               "contacts": args.contacts, "runs": args.runs, "seed": args.seed, "modes": args.modes,
+               "results": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_path = os.path.join(tmp_dir, "bench.db")
+        cr = load_bot_module(work_path)
+        for users in args.sizes:
+            source_path = os.path.join(args.data_dir, "users{}_contacts{}_seed{}.db".format(users, args.contacts,
+                                                                                           args.seed))
+            if not os.path.exists(source_path):
+                print("generating {} users with {} contacts each".format(users, args.contacts))
+                generate(cr, source_path + ".tmp", users, args.contacts, args.seed)
+                os.replace(source_path + ".tmp", source_path)
+            benchmarks = run_size(cr, work_path, source_path, users, args.runs, args.seed, args.modes)
+            results["results"][str(users)] = benchmarks
+            for name, result in benchmarks.items():
+                print("{:<10}{:<24}{:>6} runs  p50 {:>12.1f} us  p99 {:>12.1f} us".format(
+                    users, name, result["runs"], result["p50_us"], result["p99_us"]))
+        cr.db_executor.shutdown()
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+
+    with open(args.output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as old_file:
+            compare(results, json.load(old_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Posts synthetic /start updates to the WebhookListener over keep-alive HTTP connections, the way Telegram
+# delivers webhook updates, and measures the end-to-end latency from sending the request until the
+# handler answered. Also checks that oversized bodies and wrong paths are rejected.
+#
+# usage: python benchmarks/bench_webhook.py [--users 1000] [--updates 2000] [--connections 4] [--workers 4]
+import argparse
+import http.client
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+from telegram.ext import Dispatcher
+
+from bench_concurrency import DispatcherBot
+from bench_connections import load_bot_module, populate
+
+
+def update_body(update_id, chat_id, text="/start"):
+    message = {"message_id": update_id, "date": int(time.time()), "text": text,
+               "chat": {"id": chat_id, "type": "private"},
+               "from": {"id": chat_id, "is_bot": False, "first_name": "user{}".format(chat_id)},
+               "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]}
+    return json.dumps({"update_id": update_id, "message": message}).encode()
+
+
+def post(connection, path, body):
+    connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def client(address, path, chat_ids, replies, latencies):
+    connection = http.client.HTTPConnection(*address)
+    for chat_id in chat_ids:
+        event = replies[chat_id] = threading.Event()
+        start = time.perf_counter()
+        if post(connection, path, update_body(chat_id, chat_id)) != 200:
+            sys.exit("update for chat {} was rejected".format(chat_id))
+        event.wait()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end latency of the webhook listener")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=4, help="concurrent client connections")
+    parser.add_argument("--workers", type=int, default=4, help="listener and dispatcher worker threads")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "bench.db"))
+        populate(cr, args.users, 1)
+        replies = {}
+        bot = DispatcherBot(lambda chat_id: replies[chat_id].set())
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=args.workers, use_context=True)
+        cr.add_handlers(dispatcher)
+        dispatcher_thread = threading.Thread(target=dispatcher.start, daemon=True)
+        dispatcher_thread.start()
+        listener = cr.WebhookListener(bot, dispatcher.update_queue, host="127.0.0.1", port=0, url_path="hook",
+                                      workers=args.workers, max_body_size=4096).start()
+
+        # requests which the listener has to reject
+        checks = {}
+        for name, path, body in (("wrong path", "/other", update_body(1, 1)),
+                                 ("oversized body", "/hook", b" " * 8192), ("invalid json", "/hook", b"{"),
+                                 ("json string", "/hook", b'"hello"'), ("json array", "/hook", b"[1,2]"),
+                                 ("json number", "/hook", b"123")):
+            connection = http.client.HTTPConnection(*listener.address)
+            checks[name] = post(connection, path, body)
+            connection.close()
+
+        # every client connection sends its updates one after another, like Telegram does
+        latencies = []
+        chat_ids = [update % args.users + 1 for update in range(args.updates)]
+        clients = [threading.Thread(target=client, args=(listener.address, "/hook", chat_ids[ii::args.connections],
+                                                         replies, latencies))
+                   for ii in range(args.connections)]
+        start = time.monotonic()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        duration = time.monotonic() - start
+        listener.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()
+        cr.db_executor.shutdown()
+        cr.db_pool.close_all()
+        cr.db_read_pool.close_all()
+
+    latencies.sort()
+    print("rejected requests: " + ", ".join("{} -> {}".format(name, status) for name, status in checks.items()))
+    if any(status < 400 for status in checks.values()):
+        sys.exit("the listener accepted a request it should have rejected")
+    print("{} updates in {:.2f}s, {:.0f} updates/s".format(len(latencies), duration, len(latencies) / duration))
+    print("latency p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        1e3 * latencies[len(latencies) // 2], 1e3 * latencies[int(len(latencies) * 0.99)], 1e3 * latencies[-1]))
+    print("listener: {received} received, {rejected} rejected".format(**listener.stats()))
+    if any(status == 200 for status in checks.values()):
+        sys.exit("the listener accepted an invalid request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Checks and times the ReminderWheel. The wheel is driven second by second in real (UTC) time across the
+# start and the end of daylight saving time in TIMEZONE, across midnight and across a stalled tick, and every
+# chat has to be reminded exactly as often as expected: once a day, also when its reminder time falls into
+# the skipped hour in spring or the repeated hour in autumn, and not at all after a stall longer than
+# MAX_CATCH_UP. Then it reports the time of one advance() with --chats chats in the wheel.
+#
+# usage: python benchmarks/bench_wheel.py [--chats 1000000] [--ticks 1000]
+import argparse
+import collections
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pytz
+
+from bench_connections import load_bot_module
+
+
+def drive(cr, wheel, start, seconds, step=1):
+    """ advance the wheel every step seconds of real time from start (naive UTC) on
+    :return: Counter of chat_id -> number of reminders
+    """
+    fired = collections.Counter()
+    for offset in range(0, seconds + 1, step):
+        now = pytz.utc.localize(start + datetime.timedelta(seconds=offset)).astimezone(cr.LOCAL_TZ)
+        fired.update(wheel.advance(now))
+    return fired
+
+
+def transitions(tz, year):
+    """ :return: naive UTC datetimes of the DST transitions of the timezone in the given year """
+    return [moment for moment in getattr(tz, "_utc_transition_times", []) if moment.year == year]
+
+
+def check(cr):
+    """ :return: list of failed checks """
+    failures = []
+    # one chat per reminder time, among them times in the hour which is skipped or repeated
+    times = {1: "01:59:59", 2: "02:00:00", 3: "02:30:00", 4: "02:59:59", 5: "03:00:00", 6: "03:00:01",
+             7: "12:00:00", 8: "23:59:59", 9: "00:00:00"}
+    year = datetime.date.today().year + 1
+    moments = transitions(cr.LOCAL_TZ, year)
+    if not moments:
+        print("{} has no daylight saving time, only the midnight and stall checks run".format(cr.TIMEZONE))
+    for moment in moments:
+        wheel = cr.ReminderWheel()
+        for chat_id, reminder_time in times.items():
+            wheel.schedule(chat_id, cr.minute_of_day(reminder_time) * 60 + int(reminder_time[-2:]))
+        # over the two days from the afternoon before the transition on every chat is reminded twice, the
+        # afternoon keeps the ends of the run away from the reminder times
+        fired = drive(cr, wheel, moment - datetime.timedelta(hours=12, minutes=30), 48 * 3600)
+        wrong = {times[chat_id]: fired[chat_id] for chat_id in times if fired[chat_id] != 2}
+        if wrong:
+            failures.append("transition at {} UTC: reminders per time {}".format(moment, wrong))
+    # a stall longer than MAX_CATCH_UP is skipped, a shorter one is caught up on
+    for stall, expected in ((cr.ReminderWheel.MAX_CATCH_UP - 60, 1), (cr.ReminderWheel.MAX_CATCH_UP + 60, 0)):
+        wheel = cr.ReminderWheel()
+        wheel.schedule(1, 12 * 3600)
+        start = datetime.datetime(year, 1, 15, 10, 30)
+        fired = drive(cr, wheel, start, stall, step=stall)
+        if fired[1] != expected:
+            failures.append("stall of {}s: {} reminders instead of {}".format(stall, fired[1], expected))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reminder wheel checks and advance() timing")
+    parser.add_argument("--chats", type=int, default=1000000, help="chats in the wheel for the timing")
+    parser.add_argument("--ticks", type=int, default=1000, help="timed calls of advance()")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cr = load_bot_module(os.path.join(tmp_dir, "wheel.db"))
+        cr.setup_logging(level="ERROR")
+        failures = check(cr)
+        for failure in failures:
+            print("FAILED " + failure)
+        if not failures:
+            print("DST, midnight and stall checks passed")
+
+        rng = random.Random(args.seed)
+        wheel = cr.ReminderWheel()
+        for chat_id in range(args.chats):
+            wheel.schedule(chat_id, rng.randrange(86400))
+        start = datetime.datetime.now(cr.LOCAL_TZ)
+        wheel.advance(start)
+        durations = []
+        reminded = 0
+        for tick in range(1, args.ticks + 1):
+            now = start + datetime.timedelta(seconds=tick)
+            began = time.perf_counter()
+            reminded += len(wheel.advance(now))
+            durations.append(time.perf_counter() - began)
+        durations.sort()
+        print("{} chats: advance() p50 {:.1f} us, p99 {:.1f} us, {} chats reminded in {} ticks".format(
+            args.chats, 1e6 * durations[len(durations) // 2], 1e6 * durations[int(len(durations) * 0.99)],
+            reminded, args.ticks))
+    if failures:
+        sys.exit("the reminder wheel missed or repeated reminders")
+
+
+if __name__ == "__main__":
+    main()
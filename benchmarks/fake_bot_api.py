@@ -0,0 +1,151 @@
+# A minimal local stand-in for the Telegram Bot API, so that the bot can be exercised without
+# talking to Telegram. Point telegram.Bot / Updater at it with base_url=FakeBotApi.base_url.
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBotApi:
+    """ records every sendMessage call and can simulate flood control by answering
+        every n-th sendMessage call with a 429 (RetryAfter) error. Updates added with
+        push_update are handed out through getUpdates like Telegram does for polling bots
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, flood_every=0, retry_after=1):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param flood_every: answer every n-th sendMessage with 429, 0 disables flood simulation
+        :param retry_after: seconds reported in the simulated 429 answers
+        """
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.sent = []
+        self.rejected = 0
+        # called with (chat_id, text, time.monotonic()) for every delivered message
+        self.on_message = None
+        self.calls = collections.Counter()
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._updates = collections.deque()
+        self._update_id = 0
+        self._updates_cond = threading.Condition()
+        self._called = threading.Condition(self._lock)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake_bot_api", daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/bot".format(host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update):
+        """ queue an update for getUpdates, update_id is assigned here
+        :param update: update as dict without update_id
+        :return: the update_id
+        """
+        with self._updates_cond:
+            self._update_id += 1
+            self._updates.append(dict(update, update_id=self._update_id))
+            self._updates_cond.notify_all()
+            return self._update_id
+
+    def wait_for_call(self, method, timeout=None):
+        """ wait until the bot called the given Bot API method at least once
+        :return: True if it did within timeout
+        """
+        with self._called:
+            return self._called.wait_for(lambda: self.calls[method] > 0, timeout)
+
+    def messages_for(self, chat_id):
+        with self._lock:
+            return [message for message in self.sent if message["chat_id"] == chat_id]
+
+    def handle(self, method, payload):
+        """ answer a Bot API call
+        :param method: name of the Bot API method, e.g. sendMessage
+        :param payload: decoded request parameters
+        :return: tuple of HTTP status and response body as dict
+        """
+        with self._called:
+            self.calls[method] += 1
+            self._called.notify_all()
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(int(payload.get("offset") or 0),
+                                                                 float(payload.get("timeout") or 0),
+                                                                 int(payload.get("limit") or 100))}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "fake",
+                                                "username": "fake_bot"}}
+        if method == "sendMessage":
+            with self._lock:
+                self._calls += 1
+                if self.flood_every and self._calls % self.flood_every == 0:
+                    self.rejected += 1
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": "Too Many Requests: retry after {}".format(self.retry_after),
+                                 "parameters": {"retry_after": self.retry_after}}
+                self._message_id += 1
+                chat_id = int(payload["chat_id"])
+                sent_at = time.monotonic()
+                self.sent.append({"time": sent_at, "chat_id": chat_id, "text": payload.get("text")})
+                message_id = self._message_id
+            if self.on_message is not None:
+                self.on_message(chat_id, payload.get("text"), sent_at)
+            return 200, {"ok": True, "result": {"message_id": message_id, "date": int(time.time()),
+                                                "chat": {"id": chat_id, "type": "private"},
+                                                "text": payload.get("text")}}
+        return 200, {"ok": True, "result": True}
+
+    def _get_updates(self, offset, timeout, limit):
+        # long polling: wait up to timeout seconds for updates with an update_id of at least offset
+        deadline = time.monotonic() + timeout
+        with self._updates_cond:
+            while True:
+                # updates below offset have been confirmed by the bot and are dropped
+                while self._updates and self._updates[0]["update_id"] < offset:
+                    self._updates.popleft()
+                if self._updates or time.monotonic() >= deadline:
+                    return [self._updates[ii] for ii in range(min(limit, len(self._updates)))]
+                self._updates_cond.wait(deadline - time.monotonic())
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, without TCP_NODELAY the body waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    payload = json.loads(body) if body else {}
+                except ValueError:
+                    payload = {}
+                status, response = api.handle(self.path.rsplit("/", 1)[-1], payload)
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,25 +1,550 @@
 # IMPORTS
-from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, Filters
+from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, \
+    Filters, Defaults, DispatcherHandlerStop
 import telegram
+from telegram.utils.request import Request
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 import sqlite3
 import datetime
 import pytz
 import python_config
 import os
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import copy
+import cProfile
+import csv
+import functools
+import heapq
+import http.server
+import io
+import itertools
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from urllib.request import pathname2url
 
 # load configuration
 # CONF_NAME = "example_config.conf"
-CONF_NAME = "contact_reminder.conf"
+# the CONTACT_REMINDER_CONF environment variable allows tools such as the benchmarks to point to another file
+CONF_NAME = os.environ.get("CONTACT_REMINDER_CONF", "contact_reminder.conf")
 conf = python_config.load(os.path.join(os.path.dirname(os.path.realpath(__file__)), CONF_NAME))
 # global variable definition
 DB_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),conf["db_filename"])
 TIMEZONE = conf["timezone"]
+# the timezone is looked up once, pytz.timezone() is too slow to call for every user at startup
+LOCAL_TZ = pytz.timezone(TIMEZONE)
 TOKEN = conf["bot_token"]
+# optional SQLite tuning, see example_config.conf
+DB_SYNCHRONOUS = conf.get("db_synchronous", "NORMAL")
+DB_BUSY_TIMEOUT = conf.get("db_busy_timeout", 5000)
+# number of SQLite files the users are spread over by a hash of their chat_id, see shard_path()
+DB_SHARDS = conf.get("db_shards", 1)
+# database work runs on DB_READ_WORKERS reader threads and one writer thread. At most DB_MAX_PENDING tasks are
+# queued, further tasks wait DB_SUBMIT_TIMEOUT seconds for room before they fail
+DB_READ_WORKERS = conf.get("db_read_workers", 4)
+DB_MAX_PENDING = conf.get("db_max_pending", 1000)
+DB_SUBMIT_TIMEOUT = conf.get("db_submit_timeout", 1.0)
+# number of dispatcher worker threads and whether handlers run on them concurrently
+DISPATCHER_WORKERS = conf.get("dispatcher_workers", 4)
+RUN_ASYNC = conf.get("run_async", True)
+# "per_user" schedules one daily job per user, "bucketed" one daily job per minute of the day, "wheel" keeps
+# the reminder times in a ReminderWheel driven by one job
+SCHEDULER_MODE = conf.get("scheduler_mode", "per_user")
+# number of worker processes which compute the due contacts of the bucketed reminders, 0 computes them in the
+# bot process. The users of every bucket are split into this many partitions per shard
+REMINDER_PROCESSES = conf.get("reminder_processes", 0)
+# "I contacted X Y today!" updates are queued by a LastContactBuffer and committed in groups, at the latest
+# LAST_CONTACT_FLUSH_MS milliseconds after they were accepted or once LAST_CONTACT_FLUSH_ROWS are queued. At most
+# LAST_CONTACT_MAX_PENDING accepted updates are not committed yet and would be lost if the bot crashed. It must be
+# at least LAST_CONTACT_FLUSH_ROWS, the bot does not start otherwise
+LAST_CONTACT_BUFFER = conf.get("last_contact_buffer", False)
+LAST_CONTACT_FLUSH_MS = conf.get("last_contact_flush_ms", 200)
+LAST_CONTACT_FLUSH_ROWS = conf.get("last_contact_flush_rows", 500)
+LAST_CONTACT_MAX_PENDING = conf.get("last_contact_max_pending", 10000)
+# number of users read at once while the reminders are scheduled in the background at startup
+STARTUP_BATCH_SIZE = conf.get("startup_batch_size", 10000)
+# "polling" fetches updates with getUpdates, "webhook" lets Telegram post them to a built-in listener
+SERVING_MODE = conf.get("serving_mode", "polling")
+# public URL of the webhook and address, path, worker threads and maximum request body of the listener
+WEBHOOK_URL = conf.get("webhook_url", None)
+WEBHOOK_LISTEN = conf.get("webhook_listen", "0.0.0.0")
+WEBHOOK_PORT = conf.get("webhook_port", 8443)
+WEBHOOK_PATH = conf.get("webhook_path", TOKEN)
+WEBHOOK_WORKERS = conf.get("webhook_workers", 4)
+WEBHOOK_MAX_BODY_SIZE = conf.get("webhook_max_body_size", 1048576)
+# optional Bot API endpoint, e.g. a local fake server for load tests
+BOT_API_URL = conf.get("bot_api_url", None)
+# rate budget of the outbound queue used for reminders, see example_config.conf
+OUTBOUND_GLOBAL_RATE = conf.get("outbound_global_rate", 25)
+OUTBOUND_CHAT_INTERVAL = conf.get("outbound_chat_interval", 1.0)
+OUTBOUND_MAX_RETRIES = conf.get("outbound_max_retries", 5)
+OUTBOUND_MAX_QUEUE = conf.get("outbound_max_queue", 100000)
+# maximum number of chats kept in the user cache
+USER_CACHE_SIZE = conf.get("user_cache_size", 10000)
+# maximum number of chats whose list of due contacts of the day is kept in memory
+DUE_LIST_CACHE_SIZE = conf.get("due_list_cache_size", 100000)
+# time (HH:MM:SS in TIMEZONE) at which the due_today table is rebuilt for the new day
+DUE_TODAY_REFRESH_TIME = conf.get("due_today_refresh_time", "00:00:30")
+# interval in days of imported contacts without one and maximum size of an uploaded import file in bytes
+IMPORT_DEFAULT_INTERVAL = conf.get("import_default_interval", 90)
+IMPORT_MAX_FILE_SIZE = conf.get("import_max_file_size", 5242880)
+# number of contacts on one page of /printcontacts
+PRINT_CONTACTS_PAGE_SIZE = conf.get("print_contacts_page_size", 20)
+# seconds between two reports of the outbound queue and cache counters, 0 disables them
+STATS_REPORT_INTERVAL = conf.get("stats_report_interval", 60)
+# address and port of the Prometheus metrics endpoint, port 0 disables it
+METRICS_LISTEN = conf.get("metrics_listen", "127.0.0.1")
+METRICS_PORT = conf.get("metrics_port", 0)
+# fraction of the handler and job calls which are profiled with cProfile, 0 disables profiling. The
+# CONTACT_REMINDER_PROFILE_RATE environment variable overrides the configured rate. The stats are written to
+# PROFILE_DIR, keeping the newest PROFILE_MAX_FILES files per handler or job
+PROFILE_SAMPLE_RATE = float(os.environ.get("CONTACT_REMINDER_PROFILE_RATE", conf.get("profile_sample_rate", 0.0)))
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), conf.get("profile_dir", "profiles"))
+PROFILE_MAX_FILES = conf.get("profile_max_files", 20)
+# chats which may use admin commands such as /profile
+ADMIN_CHAT_IDS = conf.get("admin_chat_ids", [])
+# log records of at least LOG_LEVEL are written as JSON lines to LOG_FILE, or to stderr if it is not set, by a
+# background thread. Records which do not fit into a queue of LOG_QUEUE_SIZE records are dropped
+LOG_LEVEL = conf.get("log_level", "INFO")
+LOG_FILE = conf.get("log_file", None)
+LOG_QUEUE_SIZE = conf.get("log_queue_size", 10000)
 # global variable definition
 FIRST_NAME, LAST_NAME, INTERVAL, LAST_CONTACT = range(4)
 REMINDER_TIME = 0
-sql_dict = {}
+# index of the scheduled reminder jobs, chat_id -> job in per_user mode and minute of the day -> job in
+# bucketed mode. It holds the only live reminder job of each chat, replaced jobs are removed from the job queue
 jobs = {}
+bucket_jobs = {}
+# handlers may run concurrently, so jobs and bucket_jobs are only changed while holding this lock
+schedule_lock = threading.Lock()
+outbound_queue = None
+# process pool of the bucketed reminders if REMINDER_PROCESSES is set, see compute_bucket_partition
+reminder_pool = None
+
+
+# LOGGING
+logger = logging.getLogger("contact_reminder")
+# fields of the handler or job the current thread works for, added to every log record of the thread
+log_context = threading.local()
+# fields every LogRecord has, everything else was passed with extra= and is written as a field of its own
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """ formats a log record as one JSON object with time, level, logger and message, all fields passed with
+        extra=, e.g. chat_id, handler, duration and error, and the traceback of an exception
+    """
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created, pytz.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS)
+        if record.exc_info:
+            entry.setdefault("error", "{}: {}".format(record.exc_info[0].__name__, record.exc_info[1]))
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["traceback"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogContextFilter(logging.Filter):
+    """ adds the fields of log_context, e.g. handler and chat_id, to the records of the thread """
+
+    def filter(self, record):
+        for key, value in (getattr(log_context, "fields", None) or {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler which never blocks the logging thread: records which do not fit into the bounded queue
+        are dropped and counted
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # the message and the traceback are rendered here because the arguments and the exception may
+        # change after the call, the JSON is built on the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.error = getattr(record, "error", "{}: {}".format(record.exc_info[0].__name__, record.exc_info[1]))
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# queue handler installed by setup_logging
+log_queue_handler = None
+
+
+# helper function which sends all log records, including those of python-telegram-bot and APScheduler, through
+# a bounded queue to a background thread which writes them as JSON lines to LOG_FILE or stderr. Returns the
+# QueueListener, which has to be stopped on shutdown so that the queued records are written
+def setup_logging(level=None, path=None, queue_size=None):
+    global log_queue_handler
+    output = logging.FileHandler(path or LOG_FILE, encoding="utf-8") if path or LOG_FILE else logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    log_queue_handler = DroppingQueueHandler(queue.Queue(queue_size or LOG_QUEUE_SIZE))
+    log_queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(log_queue_handler)
+    root.setLevel((level or LOG_LEVEL).upper())
+    listener = logging.handlers.QueueListener(log_queue_handler.queue, output)
+    listener.start()
+    return listener
+
+
+# error handler of the dispatcher for exceptions raised by handlers and jobs. It runs on the thread of the
+# failed callback, so the record also gets the handler or job name from log_context
+def log_error(update, context):
+    chat = getattr(update, "effective_chat", None)
+    extra = {"chat_id": chat.id} if chat is not None else {}
+    logger.error("Unhandled error", exc_info=context.error, extra=extra)
+    log_context.fields = None
+
+
+# METRICS
+class Metrics:
+    """ registry of counters and histograms which is rendered in the Prometheus text format. A series is
+        identified by its metric name and label values and is created on first use. Further metrics can be
+        collected from callbacks at render time, e.g. the sizes of queues and caches
+    """
+
+    # upper bounds in seconds of the histogram buckets
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix="contact_reminder_"):
+        """
+        :param prefix: prefix of all metric names
+        """
+        self.prefix = prefix
+        self._meta = {}
+        self._series = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        """ set the type ("counter" or "histogram") and help text of a metric
+        :return: None
+        """
+        self._meta[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        """ add value to a counter
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ record a value, usually a duration in seconds, in a histogram
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # one count per bucket, one for +Inf and the sum of all values
+                series = self._series[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            series[bisect.bisect_left(self.BUCKETS, value)] += 1
+            series[-1] += value
+
+    def collect(self, name, metric_type, help_text, read, label=None):
+        """ register a metric whose value is read when the metrics are rendered
+        :param read: function returning a number, a dict of label value -> number if label is given, or None
+            if the metric is not available
+        :param label: name of the label of the values returned as dict
+        :return: None
+        """
+        self._meta[name] = (metric_type, help_text)
+        self._collectors[name] = (read, label)
+
+    def render(self):
+        """ :return: all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            series = {key: list(value) if isinstance(value, list) else value for key, value in self._series.items()}
+        by_name = collections.defaultdict(list)
+        for (name, labels), value in series.items():
+            by_name[name].append((labels, value))
+        for name, (read, label) in self._collectors.items():
+            value = read()
+            if isinstance(value, dict):
+                by_name[name].extend((((label, key),), item) for key, item in value.items())
+            elif value is not None:
+                by_name[name].append(((), value))
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = self._meta.get(name, ("untyped", ""))
+            full_name = self.prefix + name
+            lines.append("# HELP {} {}".format(full_name, help_text))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                if metric_type != "histogram":
+                    lines.append("{}{} {}".format(full_name, self._labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(full_name, self._labels(labels + (("le", bound),)),
+                                                         cumulative))
+                lines.append("{}_sum{} {}".format(full_name, self._labels(labels), value[-1]))
+                lines.append("{}_count{} {}".format(full_name, self._labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                               .replace("\n", "\\n")) for name, value in labels) + "}"
+
+
+metrics = Metrics()
+metrics.describe("handler_seconds", "histogram", "Duration of the update handlers.")
+metrics.describe("handler_errors_total", "counter", "Update handlers which raised an exception.")
+metrics.describe("job_seconds", "histogram", "Duration of the jobs.")
+metrics.describe("job_errors_total", "counter", "Jobs which raised an exception.")
+metrics.describe("job_lag_seconds", "histogram", "Delay between the scheduled and the actual start of job runs.")
+metrics.describe("jobs_missed_total", "counter", "Job runs which were skipped because they were too late.")
+metrics.describe("db_wait_seconds", "histogram", "Time database tasks waited for a reader or the writer thread.")
+metrics.describe("db_task_seconds", "histogram", "Duration of database tasks, writes including the commit.")
+metrics.describe("db_errors_total", "counter", "Database tasks which failed.")
+metrics.describe("last_contact_updates_total", "counter", "Buffered last contact updates which were committed.")
+metrics.describe("messages_total", "counter", "Messages sent to Telegram by method and outcome.")
+metrics.collect("db_rejected_total", "counter", "Database tasks rejected because too many were pending.",
+                lambda: sum(executor.stats()["rejected"] for executor in db_shards))
+metrics.collect("db_pending_tasks", "gauge", "Queued or running database tasks.",
+                lambda: {kind: sum(executor.stats()[kind + "s"] for executor in db_shards)
+                         for kind in ("read", "write")}, label="kind")
+metrics.collect("outbound_queue_depth", "gauge", "Messages waiting in the outbound queue.",
+                lambda: outbound_queue.stats()["depth"] if outbound_queue is not None else None)
+metrics.collect("outbound_dropped_total", "counter", "Messages dropped because the outbound queue was full.",
+                lambda: outbound_queue.stats()["dropped"] if outbound_queue is not None else None)
+metrics.collect("outbound_sender_up", "gauge", "1 while the sender thread of the outbound queue is running.",
+                lambda: int(outbound_queue.stats()["alive"]) if outbound_queue is not None else None)
+metrics.collect("user_cache_entries", "gauge", "Chats in the user cache.", lambda: user_cache.stats()["size"])
+metrics.collect("due_lists_entries", "gauge", "Chats with a due list of the day.", lambda: due_lists.stats()["size"])
+metrics.collect("reminder_jobs", "gauge", "Live reminder jobs in the job queue.",
+                lambda: len(jobs) + len(bucket_jobs))
+metrics.collect("reminder_wheel_chats", "gauge", "Chats scheduled in the reminder wheel.",
+                lambda: len(reminder_wheel) if SCHEDULER_MODE == "wheel" else None)
+metrics.collect("last_contact_pending", "gauge", "Accepted last contact updates which are not committed yet.",
+                lambda: last_contact_buffer.stats()["pending"] if last_contact_buffer is not None else None)
+metrics.collect("log_records_dropped_total", "counter", "Log records dropped because the log queue was full.",
+                lambda: log_queue_handler.dropped if log_queue_handler is not None else None)
+
+
+# helper function which wraps a handler or job callback so that its duration and exceptions are recorded
+# as <kind>_seconds and <kind>_errors_total, labelled with the name of the callback. A sample of the calls
+# is profiled, see Profiler. While the callback runs, the log records of the thread carry its name and,
+# for handlers, the chat_id of the update
+def timed_callback(callback, kind):
+    labels = {kind: callback.__name__}
+    profile_name = "{}_{}".format(kind, callback.__name__)
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        fields = dict(labels)
+        chat = getattr(args[0], "effective_chat", None) if args else None
+        if chat is not None:
+            fields["chat_id"] = chat.id
+        log_context.fields = fields
+        start = time.perf_counter()
+        try:
+            if profiler.sample():
+                result = profiler.run(profile_name, callback, *args, **kwargs)
+            else:
+                result = callback(*args, **kwargs)
+        except Exception:
+            metrics.inc(kind + "_errors_total", **labels)
+            # the fields are kept for log_error, which runs next on this thread
+            raise
+        finally:
+            fields["duration"] = time.perf_counter() - start
+            metrics.observe(kind + "_seconds", fields["duration"], **labels)
+        logger.debug("Finished %s %s", kind, labels[kind])
+        log_context.fields = None
+        return result
+
+    return wrapper
+
+
+# decorator for job callbacks which records their duration
+def timed_job(callback):
+    return timed_callback(callback, "job")
+
+
+# helper function returning a listener for the scheduler of the job queue which records how late each job run
+# was handed to the job threads and counts the runs which were skipped because they were too late
+def job_event_listener(scheduler):
+    def listener(event):
+        # jobs which only run once have already been removed from the scheduler when the event arrives
+        job = scheduler.get_job(event.job_id)
+        name = job.func.__name__ if job is not None else "once"
+        if event.code == EVENT_JOB_MISSED:
+            metrics.inc("jobs_missed_total", job=name)
+            return
+        now = datetime.datetime.now(pytz.utc)
+        for run_time in event.scheduled_run_times:
+            metrics.observe("job_lag_seconds", (now - run_time).total_seconds(), job=name)
+
+    return listener
+
+
+# helper function which names an SQL statement for the metrics by its verb and table, e.g. "select users"
+@functools.lru_cache(maxsize=256)
+def statement_label(sql):
+    words = sql.split()
+    table = next((words[ii + 1] for ii, word in enumerate(words[:-1]) if word.upper() in ("FROM", "INTO", "UPDATE")),
+                 "")
+    return (words[0].lower() + " " + table.strip("(,")).strip()
+
+
+class InstrumentedBot(telegram.Bot):
+    """ telegram.Bot which counts the messages it sends by API method and outcome, i.e. "sent" or the
+        class of the error, e.g. "RetryAfter"
+    """
+
+    def _message(self, endpoint, *args, **kwargs):
+        try:
+            result = super()._message(endpoint, *args, **kwargs)
+        except telegram.error.TelegramError as e:
+            metrics.inc("messages_total", method=endpoint, outcome=type(e).__name__)
+            raise
+        metrics.inc("messages_total", method=endpoint, outcome="sent")
+        return result
+
+
+class MetricsServer:
+    """ HTTP server which serves the metrics in the Prometheus text format under /metrics """
+
+    def __init__(self, registry, host="127.0.0.1", port=9464):
+        """
+        :param registry: Metrics to serve
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free port
+        """
+        self.registry = registry
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics_server", daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+# PROFILING
+class Profiler:
+    """ profiles a random sample of handler and job calls with cProfile. The stats of every sampled call are
+        written to <directory>/<name>/<time>.pstats, of which only the newest max_files per name are kept.
+        They can be inspected with python -m pstats. Work done on the database threads shows up as the time
+        the call waited for its futures
+    """
+
+    def __init__(self, directory, sample_rate=0.0, max_files=20):
+        """
+        :param directory: directory of the pstats files
+        :param sample_rate: fraction of the calls to profile, 0 disables profiling
+        :param max_files: number of pstats files kept per name
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.profiled = 0
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """ :return: whether the next call should be profiled
+        """
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, name, fn, *args, **kwargs):
+        """ call fn(*args, **kwargs) under cProfile and write its stats for name
+        :return: return value of fn
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            try:
+                self._dump(name, profile)
+            except OSError as e:
+                logger.warning("Could not write profile", extra={"error": str(e)})
+
+    def _dump(self, name, profile):
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory, exist_ok=True)
+        # the names sort by time, the thread id keeps concurrent calls apart
+        profile.dump_stats(os.path.join(directory, "{}_{}.pstats".format(time.time_ns(), threading.get_ident())))
+        with self._lock:
+            self.profiled += 1
+            files = sorted(file_name for file_name in os.listdir(directory) if file_name.endswith(".pstats"))
+            for file_name in files[:max(len(files) - self.max_files, 0)]:
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+
+profiler = Profiler(PROFILE_DIR, sample_rate=PROFILE_SAMPLE_RATE, max_files=PROFILE_MAX_FILES)
 
 
 # DATABASE FUNCTION DEFINITIONS
@@ -32,25 +557,273 @@ def connect_database(db_path):
     try:
         db = sqlite3.connect(db_path)
     except sqlite3.Error as e:
-        print("Error")
-        print(e)
+        logger.error("Could not connect to the database", extra={"error": str(e)})
         return
     return db
 
 
-def create_tables(db):
-    """ create the tables recipes and meals in the database
-        in case they don't already exist
-    :param db: connection object
-    :return: None
+class ConnectionManager:
+    """ hands out one long-lived SQLite connection per thread, so that the dispatcher worker
+        threads do not open and close a connection for every single update
     """
-    sql_create_user_table = """ CREATE TABLE IF NOT EXISTS users (
+
+    SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, db_path, read_only=False, synchronous="NORMAL", busy_timeout=5000):
+        """
+        :param db_path: database path
+        :param read_only: open the connections in read-only mode
+        :param synchronous: value of PRAGMA synchronous for writing connections
+        :param busy_timeout: milliseconds to wait for a database lock before giving up
+        """
+        if synchronous.upper() not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of {}".format(", ".join(self.SYNCHRONOUS_LEVELS)))
+        self.db_path = db_path
+        self.read_only = read_only
+        self.synchronous = synchronous.upper()
+        self.busy_timeout = int(busy_timeout)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self):
+        """ return the connection of the calling thread and open it on first use
+        :return: Connection object
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._open()
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def _open(self):
+        # the connection is only ever used by the thread that opened it. check_same_thread is
+        # disabled nevertheless so that close_all() can be called from the main thread on shutdown
+        if self.read_only:
+            db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(self.db_path)), uri=True,
+                                 check_same_thread=False)
+            db.execute("PRAGMA query_only = ON")
+        else:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            # WAL lets readers proceed while a write is in progress and only needs
+            # an fsync at checkpoints when combined with synchronous = NORMAL
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = {}".format(self.synchronous))
+        db.execute("PRAGMA busy_timeout = {}".format(self.busy_timeout))
+        return db
+
+    def close_all(self):
+        """ close all connections which have been handed out so far
+        :return: None
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        self._local = threading.local()
+        for db in connections:
+            db.close()
+
+
+# helper function returning the path of shard index out of shards. A single shard is the database itself, more
+# shards are named after it, e.g. reminder.db is split into reminder.shard0.db, reminder.shard1.db, ...
+def shard_path(db_path, index, shards):
+    if shards == 1:
+        return db_path
+    root, ext = os.path.splitext(db_path)
+    return "{}.shard{}{}".format(root, index, ext)
+
+
+# helper function returning the index of the shard which holds the users row and the contacts of a chat.
+# crc32 is stable across processes and spreads sequential as well as negative (group) chat ids evenly
+def shard_index(chat_id, shards):
+    if shards == 1:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+# connection managers used by the database executors, one pair per shard. Writes go through db_pools, pure
+# lookups through db_read_pools. db_pool and db_read_pool are those of the first shard, which is the whole
+# database unless it is sharded
+db_pools = [ConnectionManager(shard_path(DB_PATH, ii, DB_SHARDS), synchronous=DB_SYNCHRONOUS,
+                              busy_timeout=DB_BUSY_TIMEOUT) for ii in range(DB_SHARDS)]
+db_read_pools = [ConnectionManager(shard_path(DB_PATH, ii, DB_SHARDS), read_only=True, busy_timeout=DB_BUSY_TIMEOUT)
+                 for ii in range(DB_SHARDS)]
+db_pool, db_read_pool = db_pools[0], db_read_pools[0]
+
+
+class DatabaseBusy(sqlite3.OperationalError):
+    """ raised when the database executor has too much pending work to accept another task. It is a
+        sqlite3.Error, so handlers report it like any other database error
+    """
+
+
+class DatabaseExecutor:
+    """ runs database work off the dispatcher threads. Reads run on a bounded pool of reader threads,
+        mutations on a single writer thread, so writes never wait on each other's locks. Large batch reads
+        such as the reminder jobs get their own reader thread, so interactive reads never queue behind them.
+        Every task returns a Future. Once max_pending tasks are queued, new tasks wait up to submit_timeout
+        seconds for room and are then rejected with DatabaseBusy
+    """
+
+    def __init__(self, read_pool, write_pool, readers=4, max_pending=1000, submit_timeout=1.0):
+        """
+        :param read_pool: ConnectionManager used by the reader threads
+        :param write_pool: ConnectionManager used by the writer thread
+        :param readers: number of reader threads for interactive reads
+        :param max_pending: maximum number of queued or running tasks
+        :param submit_timeout: seconds to wait for room in the queue before a task is rejected
+        """
+        self.read_pool = read_pool
+        self.write_pool = write_pool
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db_read")
+        self._batch_reader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_batch")
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_write")
+        self._pending = {"read": 0, "write": 0}
+        self._lock = threading.Lock()
+
+    def read(self, fn, *args, batch=False, label=None):
+        """ run fn(connection, *args) with a read-only connection
+        :param batch: run on the batch reader thread instead of the interactive readers
+        :param label: name of the task in the metrics, defaults to the name of fn
+        :return: Future of the return value of fn
+        """
+        return self._submit("read", "batch" if batch else "read", self._batch_reader if batch else self._readers,
+                            self._run_read, fn, args, label)
+
+    def write(self, fn, *args, label=None):
+        """ run fn(connection, *args) inside a transaction on the writer thread
+        :param label: name of the task in the metrics, defaults to the name of fn
+        :return: Future of the return value of fn
+        """
+        return self._submit("write", "write", self._writer, self._run_write, fn, args, label)
+
+    def query(self, sql, params=(), batch=False):
+        """ :return: Future of the list of rows returned by a read-only statement
+        """
+        return self.read(lambda db: db.execute(sql, params).fetchall(), batch=batch, label=statement_label(sql))
+
+    def execute(self, sql, params=()):
+        """ :return: Future of the cursor of a committed statement, e.g. for rowcount and lastrowid
+        """
+        return self.write(lambda db: db.execute(sql, params), label=statement_label(sql))
+
+    def stats(self):
+        """ :return: dict with the number of pending reads and writes and of rejected tasks
+        """
+        with self._lock:
+            return {"reads": self._pending["read"], "writes": self._pending["write"], "rejected": self.rejected}
+
+    def shutdown(self, wait=True):
+        """ stop accepting tasks and, if wait is True, finish all pending ones
+        :return: None
+        """
+        self._readers.shutdown(wait=wait)
+        self._batch_reader.shutdown(wait=wait)
+        self._writer.shutdown(wait=wait)
+
+    def _submit(self, kind, lane, pool, runner, fn, args, label):
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise DatabaseBusy("database executor has {} pending tasks".format(self.max_pending))
+        with self._lock:
+            self._pending[kind] += 1
+        try:
+            future = pool.submit(self._run, lane, label or fn.__name__, runner, fn, args, time.perf_counter())
+        except RuntimeError:
+            # the executor has been shut down
+            self._release(kind)
+            raise
+        future.add_done_callback(lambda _: self._release(kind))
+        return future
+
+    def _release(self, kind):
+        with self._lock:
+            self._pending[kind] -= 1
+        self._slots.release()
+
+    def _run(self, lane, label, runner, fn, args, submitted):
+        # records the time the task waited for its thread and its duration
+        started = time.perf_counter()
+        metrics.observe("db_wait_seconds", started - submitted, lane=lane)
+        try:
+            return runner(fn, args)
+        except sqlite3.Error:
+            metrics.inc("db_errors_total", lane=lane, task=label)
+            raise
+        finally:
+            metrics.observe("db_task_seconds", time.perf_counter() - started, lane=lane, task=label)
+
+    def _run_read(self, fn, args):
+        return fn(self.read_pool.get(), *args)
+
+    def _run_write(self, fn, args):
+        db = self.write_pool.get()
+        with db:
+            return fn(db, *args)
+
+
+# executors through which handlers and jobs run all database work, one per shard so that every shard has its
+# own writer thread. Handlers reach the shard of their chat through db_for(), jobs which span all users go
+# through every executor in db_shards. db_executor is the executor of the first shard
+db_shards = [DatabaseExecutor(read_pool, write_pool, readers=DB_READ_WORKERS, max_pending=DB_MAX_PENDING,
+                              submit_timeout=DB_SUBMIT_TIMEOUT)
+             for read_pool, write_pool in zip(db_read_pools, db_pools)]
+db_executor = db_shards[0]
+
+
+# helper function returning the executor of the shard which holds the data of a chat
+def db_for(chat_id):
+    return db_shards[shard_index(chat_id, DB_SHARDS)]
+
+
+# helper function which runs a read-only statement on all shards at once and returns the list of rows of
+# every shard, in shard order
+def query_all_shards(sql, params=(), batch=True):
+    futures = [executor.query(sql, params, batch=batch) for executor in db_shards]
+    return [future.result() for future in futures]
+
+
+# helper function which finishes the pending database work and closes the connections of all shards
+def close_databases():
+    for executor in db_shards:
+        executor.shutdown()
+    for pool in db_pools + db_read_pools:
+        pool.close_all()
+
+
+# SCHEMA MIGRATIONS
+# helper function for migration 4 which fills reminder_minute from reminder_time. A reminder_time which cannot
+# be parsed is logged with its user and fails the migration
+def migrate_reminder_minute(db):
+    rows = []
+    for user_id, reminder_time in db.execute(""" SELECT user_id, reminder_time FROM users """).fetchall():
+        try:
+            rows.append((minute_of_day(reminder_time), user_id))
+        except (ValueError, TypeError) as e:
+            logger.error("Invalid reminder time", extra={"user_id": user_id, "reminder_time": repr(reminder_time)})
+            raise ValueError("invalid reminder_time {!r} of user {}".format(reminder_time, user_id)) from e
+    db.executemany(""" UPDATE users SET reminder_minute = ? WHERE user_id = ? """, rows)
+
+
+# MIGRATIONS[n] holds the statements which bring the schema from version n to version n + 1. The version
+# of a database is stored in PRAGMA user_version. Only ever append to this list and never edit a migration
+# which has already been released. Migrations run at startup, so they must not rebuild or copy whole tables:
+# stick to CREATE ... IF NOT EXISTS, ALTER TABLE ... ADD COLUMN and set-based UPDATEs.
+MIGRATIONS = [
+    # 1: initial schema
+    [""" CREATE TABLE IF NOT EXISTS users (
                                         user_id integer PRIMARY KEY,
                                         chat_id integer NOT NULL,
                                         is_active integer NOT NULL,
                                         reminder_time TEXT NOT NULL
-                                        ); """
-    sql_create_contact_table = """ CREATE TABLE IF NOT EXISTS contacts (
+                                        ); """,
+     """ CREATE TABLE IF NOT EXISTS contacts (
                                     contact_id integer PRIMARY KEY,
                                     first_name text NOT NULL,
                                     last_name text,
@@ -59,39 +832,911 @@ def create_tables(db):
                                     user_id integer NOT NULL,
                                     FOREIGN KEY (user_id) REFERENCES users (user_id),
                                     UNIQUE (first_name, last_name, user_id)
-                                    ); """
+                                    ); """],
+    # 2: indexes for the chat_id lookup done by every handler and for the per user contact scans
+    # and name lookups. The UNIQUE constraint above starts with first_name and cannot serve those
+    [""" CREATE INDEX IF NOT EXISTS idx_users_chat_id ON users (chat_id) """,
+     """ CREATE INDEX IF NOT EXISTS idx_contacts_user_name ON contacts (user_id, first_name, last_name) """],
+    # 3: next_due holds the day number (see date.toordinal) on which a contact is due again, so that
+    # the reminder only has to do an indexed range query. Contacts without last contact are due right away
+    [""" ALTER TABLE contacts ADD COLUMN next_due integer """,
+     """ UPDATE contacts SET next_due = IFNULL(CAST(julianday(replace(last_contact, '_', '-')) - 1721424.5
+                                                    AS integer) + interval, 0) """,
+     """ CREATE INDEX IF NOT EXISTS idx_contacts_user_due ON contacts (user_id, next_due) """],
+    # 4: reminder_minute holds the minute of the day of reminder_time for the bucketed scheduler.
+    # reminder_time is free text which strptime accepted (e.g. "8:00:00"), so it is parsed in python
+    [""" ALTER TABLE users ADD COLUMN reminder_minute integer """,
+     migrate_reminder_minute,
+     """ CREATE INDEX IF NOT EXISTS idx_users_bucket ON users (reminder_minute, is_active) """],
+    # 5: index for the keyset pagination of /printcontacts. Every index ends with the rowid, i.e. contact_id,
+    # so this one serves 'user_id = ? AND contact_id > ? ORDER BY contact_id'
+    [""" CREATE INDEX IF NOT EXISTS idx_contacts_user ON contacts (user_id) """],
+    # 6: due_today holds the contacts which are due on the day number stored in bot_state under 'due_today_day'.
+    # It is rebuilt every night by refresh_due_today() and kept in line by every change of a contact
+    [""" CREATE TABLE IF NOT EXISTS due_today (
+                                    user_id integer NOT NULL,
+                                    contact_id integer NOT NULL,
+                                    first_name text NOT NULL,
+                                    last_name text,
+                                    PRIMARY KEY (user_id, contact_id)
+                                    ) WITHOUT ROWID; """,
+     """ CREATE TABLE IF NOT EXISTS bot_state (
+                                    key text PRIMARY KEY,
+                                    value
+                                    ); """],
+]
+
+
+def create_tables(db):
+    """ create the tables in the database in case they don't already exist and
+        apply all pending schema migrations. A failing migration is rolled back, logged and raised,
+        so that the bot does not start on a database whose migration is missing
+    :param db: connection object
+    :return: None
+    """
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        logger.warning("Database schema version %d is newer than this bot (%d)", version, len(MIGRATIONS))
+    for new_version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        # the statements and the version bump share one transaction, so an interrupted
+        # migration leaves the database at the previous version and is simply retried
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for sql in statements:
+                # migrations which cannot be expressed in SQL are given as functions of the connection
+                if callable(sql):
+                    sql(db)
+                else:
+                    db.execute(sql)
+            db.execute("PRAGMA user_version = {}".format(new_version))
+            db.commit()
+        except (sqlite3.Error, ValueError) as e:
+            db.rollback()
+            logger.error("Could not migrate the database", extra={
+                "version": new_version, "statement": sql.__name__ if callable(sql) else " ".join(sql.split()),
+                "error": str(e)})
+            raise
+        logger.info("Migrated database to schema version %d", new_version)
+
+
+# helper function which creates or migrates the tables of every shard
+def create_all_tables():
+    for pool in db_pools:
+        create_tables(pool.get())
+
+
+# helper function returning today's day number in TIMEZONE as used in the next_due column
+def today_day():
+    return datetime.datetime.now(LOCAL_TZ).date().toordinal()
+
+
+# helper function to compute the day number on which a contact is due again from its
+# last_contact string (YYYY_MM_DD) and its interval in days
+def due_day(last_contact, interval):
+    return datetime.datetime.strptime(last_contact, '%Y_%m_%d').date().toordinal() + interval
+
 
+# helper function to convert a reminder time string (HH:MM:SS) into the minute of the day. Users share few
+# distinct reminder times, so the results are cached instead of calling strptime for every user
+@functools.lru_cache(maxsize=86400)
+def minute_of_day(reminder_time):
+    reminder_datetime = datetime.datetime.strptime(reminder_time, '%H:%M:%S')
+    return reminder_datetime.hour * 60 + reminder_datetime.minute
+
+
+# helper function to convert a reminder time string (HH:MM:SS) into a time in TIMEZONE, cached like minute_of_day
+@functools.lru_cache(maxsize=86400)
+def local_time_of_day(reminder_time):
+    # replace timezone as PTB needs timezone-aware objects
+    return datetime.datetime.strptime(reminder_time, '%H:%M:%S').time().replace(tzinfo=LOCAL_TZ)
+
+
+# USER CACHE
+UserEntry = collections.namedtuple("UserEntry", ["user_id", "is_active", "reminder_time"])
+
+
+class UserCache:
+    """ bounded LRU cache of chat_id -> UserEntry, so that most updates don't need to query the
+        users table. Every handler which changes a user row has to update or invalidate its entry
+    """
+
+    def __init__(self, maxsize=10000):
+        """
+        :param maxsize: maximum number of cached chats
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        """ :return: cached UserEntry of the chat or None
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(chat_id)
+            return entry
+
+    def put(self, chat_id, entry):
+        with self._lock:
+            self._entries[chat_id] = entry
+            self._entries.move_to_end(chat_id)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def stats(self):
+        """ :return: dict with hit and miss counters, hit rate and number of cached chats
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+user_cache = UserCache(USER_CACHE_SIZE)
+
+
+# DUE TODAY
+# day number whose due contacts are in the due_today table or None. Readers only use the table while it holds
+# today, otherwise they fall back to the next_due range query on contacts
+due_today_day = None
+
+
+# helper function for the database executor which fills due_today with all contacts due on day in one
+# set-based pass over contacts
+def refresh_due_today(db, day):
+    db.execute(''' DELETE FROM due_today ''')
+    db.execute(''' INSERT INTO due_today (user_id, contact_id, first_name, last_name)
+    SELECT user_id, contact_id, first_name, last_name FROM contacts WHERE next_due <= ?''', (day,))
+    db.execute(''' INSERT OR REPLACE INTO bot_state (key, value) VALUES ('due_today_day', ?)''', (day,))
+
+
+# helper function for the database executor which brings the due_today rows of a user in line with contacts
+# after a contact was added, edited, marked as contacted or deleted. Without a name all contacts of the user
+# are synced, e.g. after an import. Nothing is inserted as long as due_today has never been filled
+def sync_due_today(db, user_id, first_name=None, last_name=None):
+    where = "user_id = ?" if first_name is None else "user_id = ? AND first_name = ? AND last_name = ?"
+    params = (user_id,) if first_name is None else (user_id, first_name, last_name)
+    db.execute(''' DELETE FROM due_today WHERE ''' + where, params)
+    db.execute(''' INSERT INTO due_today (user_id, contact_id, first_name, last_name)
+    SELECT user_id, contact_id, first_name, last_name FROM contacts
+    WHERE ''' + where + ''' AND next_due <= (SELECT value FROM bot_state WHERE key = 'due_today_day')''', params)
+
+
+# job which rebuilds due_today for the new day. It runs daily just after midnight in TIMEZONE, on all shards
+# at once
+@timed_job
+def refresh_due_today_job(context: telegram.ext.CallbackContext) -> None:
+    global due_today_day
+    day = today_day()
+    start = time.monotonic()
     try:
-        cur = db.cursor()
-        cur.execute(sql_create_user_table)
-        cur.execute(sql_create_contact_table)
+        for future in [executor.write(refresh_due_today, day) for executor in db_shards]:
+            future.result()
     except sqlite3.Error as e:
-        print("Error")
-        print(e)
+        logger.error("Could not refresh the due contacts of the day", extra={"error": str(e)})
+        return
+    # only switch the readers over once the new rows are committed
+    due_today_day = day
+    logger.info("Refreshed the due contacts of the day", extra={"duration": time.monotonic() - start})
+
+
+# helper function which schedules the nightly refresh of due_today. A table which does not hold today,
+# e.g. because the bot was down at midnight, is rebuilt right away in the background
+def schedule_due_today(job_queue):
+    global due_today_day
+    job_queue.run_daily(refresh_due_today_job, time=local_time_of_day(DUE_TODAY_REFRESH_TIME),
+                        name="due_today_refresh")
+    try:
+        days = [rows[0][0] if rows else None for rows in
+                query_all_shards(''' SELECT value FROM bot_state WHERE key = 'due_today_day' ''', batch=False)]
+    except sqlite3.Error as e:
+        logger.error("Could not read the day of the due contacts", extra={"error": str(e)})
+        days = [None]
+    if all(day == today_day() for day in days):
+        due_today_day = days[0]
+    else:
+        job_queue.run_once(refresh_due_today_job, when=0, name="due_today_refresh")
+
+
+# helper function returning the names ("first_name last_name") of the contacts of a user which are due on day
+def query_due_contacts(chat_id, user_id, day):
+    if due_today_day == day:
+        sql = '''SELECT first_name, last_name FROM due_today WHERE user_id = ? ORDER BY contact_id'''
+        params = (user_id,)
+    else:
+        sql = '''SELECT first_name, last_name FROM contacts WHERE user_id = ? AND next_due <= ? ORDER BY contact_id'''
+        params = (user_id, day)
+    return [row[0] + ' ' + row[1] for row in db_for(chat_id).query(sql, params).result()]
+
+
+# DUE LISTS
+class DueLists:
+    """ keeps the names of the contacts which are due today per chat, in reminder order. A list is created
+        when a chat is reminded and shrinks whenever the user marks a contact as contacted, so the reply
+        keyboard can be rebuilt without querying the contacts again. Lists of past days are dropped and
+        at most maxsize chats are kept, least recently used first out
+    """
+
+    def __init__(self, maxsize=100000):
+        """
+        :param maxsize: maximum number of chats with a due list
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._day = None
+        self._lists = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, chat_id, day, names):
+        """ store the due contacts ("first_name last_name") of a chat on the given day number
+        :return: None
+        """
+        with self._lock:
+            if day != self._day:
+                self._day = day
+                self._lists.clear()
+            self._lists[chat_id] = dict.fromkeys(names)
+            self._lists.move_to_end(chat_id)
+            if len(self._lists) > self.maxsize:
+                self._lists.popitem(last=False)
+
+    def mark_done(self, chat_id, day, name):
+        """ remove a contacted name from the due list of a chat
+        :return: list of the remaining due names or None if there is no list of that day for the chat
+        """
+        with self._lock:
+            names = self._lists.get(chat_id) if day == self._day else None
+            if names is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._lists.move_to_end(chat_id)
+            names.pop(name, None)
+            return list(names)
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._lists.pop(chat_id, None)
+
+    def stats(self):
+        """ :return: dict with hit and miss counters and number of chats with a due list
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._lists)}
+
+
+due_lists = DueLists(DUE_LIST_CACHE_SIZE)
+
+
+# helper function to get the users row of a chat, from the cache if possible.
+# Returns None for unregistered chats, database errors are raised to the caller
+def lookup_user(chat_id):
+    user = user_cache.get(chat_id)
+    if user is None:
+        sql = ''' SELECT user_id, is_active, reminder_time FROM users WHERE chat_id = ?'''
+        rows = db_for(chat_id).query(sql, (chat_id,)).result()
+        row = rows[0] if rows else None
+        if row is not None:
+            user = UserEntry(*row)
+            user_cache.put(chat_id, user)
+    return user
 
 
 # helper function to check if a user is a registered user in the users table
-def is_registered(db_path, chat_id):
-    db = connect_database(db_path)
-    sql = ''' SELECT user_id FROM users WHERE chat_id = ?'''
-    try:
-        cur = db.cursor()
-        cur.execute(sql, (chat_id,))
-        is_registered_user = True if cur.fetchone() is not None else False
-        db.close()
-        return is_registered_user
+def is_registered(chat_id):
+    try:
+        return lookup_user(chat_id) is not None
     except sqlite3.Error as e:
-        print(e)
-        db.close()
+        logger.error("Could not look up the user", extra={"chat_id": chat_id, "error": str(e)})
         return None
 
 
+# LAST CONTACT BUFFER
+class LastContactBuffer:
+    """ write-behind buffer for the "I contacted X Y today!" updates. Instead of one transaction and fsync per
+        reply, the updates are queued per shard and a background thread commits all queued updates of a shard
+        in one transaction once the oldest of them waited flush_interval seconds or flush_rows are queued.
+        Until then readers see the old last contact. Accepted updates which are not committed yet are lost
+        if the bot crashes, so at most max_pending of them are kept: further updates wait up to
+        submit_timeout seconds for room before they are rejected with DatabaseBusy. stop() commits the rest
+    """
+
+    def __init__(self, executors, flush_interval=0.2, flush_rows=500, max_pending=10000, submit_timeout=1.0):
+        """
+        :param executors: DatabaseExecutor of every shard, in shard order
+        :param flush_interval: maximum number of seconds an update is queued before its commit starts
+        :param flush_rows: number of queued updates which are committed right away
+        :param max_pending: maximum number of accepted updates which are not committed yet, at least flush_rows
+        :param submit_timeout: seconds to wait for room in the buffer before an update is rejected
+        """
+        if max_pending < flush_rows:
+            raise ValueError("max_pending must be at least flush_rows, otherwise the buffer fills up before it "
+                             "is flushed")
+        self.executors = executors
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.flushed = 0
+        self.flushes = 0
+        self.failed = 0
+        self.rejected = 0
+        # per shard (user_id, first_name, last_name) -> day of the last contact, queued and being committed
+        self._queued = [{} for _ in executors]
+        self._flushing = [{} for _ in executors]
+        self._size = 0
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="last_contact_buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ stop the buffer after all queued updates have been committed
+        :param timeout: seconds to wait for the last commit
+        :return: None
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def add(self, chat_id, user_id, first_name, last_name, day):
+        """ queue setting the last contact of a contact to day. A later update of the same contact replaces
+            a queued one
+        :return: None
+        """
+        deadline = time.monotonic() + self.submit_timeout
+        key = (user_id, first_name, last_name)
+        shard = shard_index(chat_id, len(self.executors))
+        with self._cond:
+            # the flusher replaces the queued dicts, so they are looked up again after every wait
+            while key not in self._queued[shard] and self._size >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise DatabaseBusy("last contact buffer has {} pending updates".format(self.max_pending))
+                # the buffer is full, so make the flusher commit it right away instead of at the next interval
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+            queued = self._queued[shard]
+            if key not in queued:
+                self._size += 1
+            queued[key] = day
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify_all()
+            elif self._size - self._flushing_size() >= self.flush_rows:
+                self._cond.notify_all()
+
+    def pending_names(self, chat_id, user_id):
+        """ :return: set of the names ("first_name last_name") of the contacts of a user whose update is not
+            committed yet
+        """
+        shard = shard_index(chat_id, len(self.executors))
+        with self._cond:
+            return {first_name + ' ' + last_name
+                    for updates in (self._queued[shard], self._flushing[shard])
+                    for (pending_user_id, first_name, last_name) in updates if pending_user_id == user_id}
+
+    def stats(self):
+        """ :return: dict with the number of uncommitted updates, committed updates and flushes and the
+            counters of failed flushes and rejected updates
+        """
+        with self._cond:
+            return {"pending": self._size, "flushed": self.flushed, "flushes": self.flushes, "failed": self.failed,
+                    "rejected": self.rejected}
+
+    def _flushing_size(self):
+        return sum(len(updates) for updates in self._flushing)
+
+    def _next(self):
+        # wait until the queued updates are due, then move them to _flushing
+        with self._cond:
+            while self._running:
+                if self._size >= self.flush_rows:
+                    break
+                if self._oldest is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.flush_interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._flushing, self._queued = self._queued, [{} for _ in self.executors]
+            self._oldest = None
+            return self._running
+
+    def _run(self):
+        while True:
+            running = self._next()
+            futures = []
+            for shard, updates in enumerate(self._flushing):
+                if updates:
+                    rows = [key + (day,) for key, day in updates.items()]
+                    try:
+                        future = self.executors[shard].write(mark_contacted_many, rows, label="flush_last_contacts")
+                    except sqlite3.Error as e:
+                        # e.g. DatabaseBusy, handled like a failed commit
+                        future = concurrent.futures.Future()
+                        future.set_exception(e)
+                    futures.append((shard, future))
+            for shard, future in futures:
+                try:
+                    future.result()
+                    failed = False
+                except sqlite3.Error as e:
+                    failed = True
+                    logger.error("Could not commit the last contacts", extra={
+                        "shard": shard, "updates": len(self._flushing[shard]), "error": str(e),
+                        "retry": running})
+                with self._cond:
+                    updates = self._flushing[shard]
+                    self._flushing[shard] = {}
+                    if failed and running:
+                        # queue the updates again unless the contact got a newer one in the meantime
+                        queued = self._queued[shard]
+                        self._size -= sum(1 for key in updates if key in queued)
+                        for key, day in updates.items():
+                            queued.setdefault(key, day)
+                        if self._oldest is None:
+                            self._oldest = time.monotonic()
+                        self.failed += 1
+                    else:
+                        self._size -= len(updates)
+                        if failed:
+                            self.failed += 1
+                        else:
+                            self.flushed += len(updates)
+                            self.flushes += 1
+                            metrics.inc("last_contact_updates_total", len(updates))
+                    self._cond.notify_all()
+            if not running:
+                return
+
+
+last_contact_buffer = None
+
+
+# REMINDER WHEEL
+class WheelEntry:
+    """ reminder of one chat in the ReminderWheel """
+    __slots__ = ("second", "enabled")
+
+    def __init__(self, second, enabled):
+        self.second = second
+        self.enabled = enabled
+
+
+class ReminderWheel:
+    """ daily timing wheel with one slot per second of the day, holding the chats which are reminded at
+        that second. It replaces one scheduler job per user by a compact entry per chat, so scheduling,
+        enabling, disabling and moving a reminder are dict and set operations. A single job calls advance()
+        every second to collect the chats whose reminder time has passed since the previous call
+    """
+
+    # seconds of real time which advance() catches up on after a stalled tick, larger gaps are skipped
+    MAX_CATCH_UP = 3600
+
+    def __init__(self):
+        self._entries = {}
+        self._slots = collections.defaultdict(set)
+        self._position = None
+        self._timestamp = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, chat_id, second, enabled=True, replace=True):
+        """ remind the chat daily at the given second of the day
+        :param replace: whether an existing entry of the chat is moved, otherwise it is kept
+        :return: None
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self._entries[chat_id] = WheelEntry(second, enabled)
+            elif replace:
+                self._discard(chat_id, entry.second)
+                entry.second = second
+                entry.enabled = enabled
+            else:
+                return
+            self._slots[second].add(chat_id)
+
+    def set_enabled(self, chat_id, enabled):
+        """ :return: True if the chat has an entry, False otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return False
+            entry.enabled = enabled
+            return True
+
+    def remove(self, chat_id):
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+            if entry is not None:
+                self._discard(chat_id, entry.second)
+
+    def advance(self, now):
+        """ move the wheel to the given time. The slots are seconds of the local day, so at the start of
+            daylight saving time the wheel jumps over the skipped hour and fires its slots at once, and at the
+            end of it the repeated hour fires nothing
+        :param now: timezone-aware datetime in the timezone of the reminder times
+        :return: list of the enabled chats due since the previous call, empty on the first call
+        """
+        position = now.date().toordinal() * 86400 + now.hour * 3600 + now.minute * 60 + now.second
+        timestamp = now.timestamp()
+        with self._lock:
+            previous, self._position = self._position, max(position, self._position or position)
+            previous_timestamp, self._timestamp = self._timestamp, timestamp
+            if previous is None or position <= previous:
+                # first call, or the clock went back, e.g. at the end of daylight saving time
+                return []
+            # a stall is measured in real time, the local position also jumps by an hour at a DST gap
+            if timestamp - previous_timestamp > self.MAX_CATCH_UP:
+                logger.warning("Skipped reminders of a stalled wheel",
+                               extra={"seconds": timestamp - previous_timestamp})
+                return []
+            due = []
+            for pos in range(previous + 1, position + 1):
+                slot = self._slots.get(pos % 86400)
+                if slot:
+                    due.extend(chat_id for chat_id in slot if self._entries[chat_id].enabled)
+            return due
+
+    def stats(self):
+        """ :return: dict with the number of chats and of occupied seconds
+        """
+        with self._lock:
+            return {"chats": len(self._entries), "slots": len(self._slots)}
+
+    def _discard(self, chat_id, second):
+        slot = self._slots.get(second)
+        if slot is not None:
+            slot.discard(chat_id)
+            if not slot:
+                del self._slots[second]
+
+
+reminder_wheel = ReminderWheel()
+
+
+# OUTBOUND MESSAGE QUEUE
+class OutboundQueue:
+    """ sends messages from a background thread without exceeding Telegram's flood limits. It keeps
+        a global budget of messages per second and a minimum interval between two messages to the
+        same chat. Messages rejected with RetryAfter pause all sending for the requested time and
+        are then retried, network errors are retried with exponential backoff. At most max_size messages
+        are queued, further messages are dropped
+    """
+
+    def __init__(self, bot, global_rate=25, chat_interval=1.0, max_retries=5, backoff=0.5, max_size=100000):
+        """
+        :param bot: telegram.Bot used for sending
+        :param global_rate: maximum number of messages per second over all chats
+        :param chat_interval: minimum number of seconds between two messages to the same chat
+        :param max_retries: number of retries after network errors before a message is dropped
+        :param backoff: seconds to wait before the first retry, doubled for every further retry
+        :param max_size: maximum number of queued messages
+        """
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_size = max_size
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        # heap of (not_before, sequence number, chat_id, send_message kwargs, attempt)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._chat_ready = {}
+        self._window = collections.deque()
+        self._sent_times = collections.deque()
+        self._paused_until = 0.0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="outbound_queue", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ stop the queue after all pending messages have been handed to Telegram
+        :param timeout: seconds to wait for the queue to drain
+        :return: None
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def send_message(self, chat_id, **kwargs):
+        """ queue a message. Takes the same arguments as telegram.Bot.send_message. The message is dropped if
+            the queue is full
+        :return: None
+        """
+        with self._cond:
+            if len(self._heap) >= self.max_size:
+                self.dropped += 1
+                logger.error("Outbound queue is full, message dropped", extra={"chat_id": chat_id,
+                                                                               "depth": len(self._heap)})
+                return
+        self._push(time.monotonic(), chat_id, kwargs, 0)
+
+    def stats(self):
+        """ :return: dict with queue depth, sent/failed/retried/dropped counters, messages per second over the last
+            minute and whether the sender thread is alive
+        """
+        with self._cond:
+            now = time.monotonic()
+            while self._sent_times and self._sent_times[0] < now - 60:
+                self._sent_times.popleft()
+            return {"depth": len(self._heap), "sent": self.sent, "failed": self.failed,
+                    "retried": self.retried, "dropped": self.dropped, "throughput": len(self._sent_times) / 60,
+                    "alive": self._thread is not None and self._thread.is_alive()}
+
+    def _push(self, not_before, chat_id, kwargs, attempt):
+        with self._cond:
+            heapq.heappush(self._heap, (not_before, next(self._seq), chat_id, kwargs, attempt))
+            self._cond.notify()
+
+    def _next(self):
+        # wait for the next message which may be sent right now within the rate budget
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._heap:
+                    if not self._running:
+                        return None
+                    self._cond.wait()
+                    continue
+                not_before = max(self._heap[0][0], self._paused_until)
+                if not_before > now:
+                    self._cond.wait(not_before - now)
+                    continue
+                # global budget as sliding window over the last second. While it is used up the heap is left
+                # alone, so a long backlog costs nothing until the window has room again
+                while self._window and self._window[0] <= now - 1:
+                    self._window.popleft()
+                if len(self._window) >= self.global_rate:
+                    self._cond.wait(self._window[0] + 1 - now)
+                    continue
+                item = heapq.heappop(self._heap)
+                chat_id = item[2]
+                # per chat budget, postpone the message until the chat may receive again
+                chat_ready = self._chat_ready.get(chat_id, 0.0)
+                if chat_ready > now:
+                    heapq.heappush(self._heap, (chat_ready,) + item[1:])
+                    continue
+                self._window.append(now)
+                self._chat_ready[chat_id] = now + self.chat_interval
+                if len(self._chat_ready) > 10000:
+                    self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+                return item
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            _, _, chat_id, kwargs, attempt = item
+            try:
+                self.bot.send_message(chat_id=chat_id, **kwargs)
+            except telegram.error.RetryAfter as e:
+                # flood control applies to the whole bot, so stop sending until it has passed
+                with self._cond:
+                    self._paused_until = time.monotonic() + e.retry_after
+                    self.retried += 1
+                self._push(time.monotonic() + e.retry_after, chat_id, kwargs, attempt)
+                continue
+            except (telegram.error.BadRequest, telegram.error.Unauthorized) as e:
+                # BadRequest is a NetworkError but retrying it won't help. Unauthorized means the user blocked us
+                logger.warning("Message rejected by Telegram", extra={"chat_id": chat_id, "error": str(e)})
+                self.failed += 1
+                continue
+            except telegram.error.NetworkError as e:
+                if attempt < self.max_retries:
+                    self.retried += 1
+                    self._push(time.monotonic() + self.backoff * 2 ** attempt, chat_id, kwargs, attempt + 1)
+                else:
+                    logger.error("Message dropped after %d retries", attempt, extra={"chat_id": chat_id, "error": str(e)})
+                    self.failed += 1
+                continue
+            except telegram.error.TelegramError as e:
+                logger.error("Could not send message", extra={"chat_id": chat_id, "error": str(e)})
+                self.failed += 1
+                continue
+            except Exception as e:
+                # any other error must not end the sender thread, otherwise no reminder is sent anymore
+                logger.error("Unexpected error while sending message", exc_info=e, extra={"chat_id": chat_id})
+                self.failed += 1
+                continue
+            with self._cond:
+                self.sent += 1
+                self._sent_times.append(time.monotonic())
+
+
+# helper function returning what the reminders are sent through: the outbound queue if the bot
+# runs one, otherwise the bot itself
+def reminder_sender(context):
+    return outbound_queue if outbound_queue is not None else context.bot
+
+
+# WEBHOOK LISTENER
+class WebhookListener:
+    """ HTTP listener which receives the updates Telegram posts to the webhook and puts them into the
+        update queue of the dispatcher. Requests are handled by a fixed number of worker threads and
+        bodies larger than max_body_size are rejected before they are read. TLS is expected to be
+        terminated by a reverse proxy or load balancer in front of the listener
+    """
+
+    def __init__(self, bot, update_queue, host="0.0.0.0", port=8443, url_path="", workers=4,
+                 max_body_size=1048576, timeout=60):
+        """
+        :param bot: telegram.Bot the updates are bound to
+        :param update_queue: queue of the dispatcher
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param url_path: path Telegram posts to, requests to any other path are rejected
+        :param workers: number of threads handling requests, one per open connection
+        :param max_body_size: maximum accepted request body in bytes
+        :param timeout: seconds an idle connection is kept open
+        """
+        self.bot = bot
+        self.update_queue = update_queue
+        self.url_path = "/" + url_path.strip("/")
+        self.max_body_size = max_body_size
+        self.received = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._server = _PooledHTTPServer((host, port), self._handler_class(timeout), workers)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook_listener", daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._server.pool.shutdown(wait=True)
+
+    def stats(self):
+        """ :return: dict with the number of received and rejected requests
+        """
+        with self._lock:
+            return {"received": self.received, "rejected": self.rejected}
+
+    def handle(self, path, content_length, read_body):
+        """ answer a webhook request
+        :param path: request path
+        :param content_length: value of the Content-Length header or None
+        :param read_body: function which reads the given number of bytes of the body
+        :return: HTTP status
+        """
+        if path != self.url_path:
+            status = 403
+        elif content_length is None:
+            status = 411
+        elif content_length > self.max_body_size:
+            status = 413
+        else:
+            try:
+                data = json.loads(read_body(content_length))
+                # valid JSON which is no object, e.g. a string or a list, is no update either
+                update = telegram.Update.de_json(data, self.bot) if isinstance(data, dict) else None
+            except (ValueError, TypeError, KeyError, AttributeError):
+                update = None
+            status = 400 if update is None else 200
+            if update is not None:
+                self.update_queue.put(update)
+        with self._lock:
+            if status == 200:
+                self.received += 1
+            else:
+                self.rejected += 1
+        return status
+
+    def _handler_class(self, timeout):
+        listener = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep connections open, Telegram sends the updates of one connection one after another
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                self.timeout = timeout
+                super().setup()
+
+            def do_POST(self):
+                try:
+                    content_length = int(self.headers["Content-Length"])
+                except (TypeError, ValueError):
+                    content_length = None
+                status = listener.handle(self.path, content_length, self.rfile.read)
+                if status in (403, 411, 413):
+                    # the body has not been read, so the connection cannot be used for another request
+                    self.close_connection = True
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class _PooledHTTPServer(http.server.HTTPServer):
+    """ HTTPServer which handles its connections on a fixed size thread pool """
+
+    def __init__(self, server_address, handler_class, workers):
+        super().__init__(server_address, handler_class)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+# job which logs the state of the outbound queue, the caches and the database executor
+@timed_job
+def report_stats(context: telegram.ext.CallbackContext) -> None:
+    if outbound_queue is not None:
+        logger.info("Outbound queue", extra=outbound_queue.stats())
+    logger.info("User cache", extra=user_cache.stats())
+    logger.info("Due lists", extra=due_lists.stats())
+    if last_contact_buffer is not None:
+        logger.info("Last contact buffer", extra=last_contact_buffer.stats())
+    logger.info("Reminder jobs", extra={"jobs": len(jobs), "bucket_jobs": len(bucket_jobs)})
+    if SCHEDULER_MODE == "wheel":
+        logger.info("Reminder wheel", extra=reminder_wheel.stats())
+    for shard, executor in enumerate(db_shards):
+        logger.info("Database executor", extra=dict(executor.stats(), shard=shard))
+
+
 # CHATBOT FUNCTION DEFINITIONS, HANDLERS AND DISPATCHER
 # start command
 def start(update, context):
     # query database for chat id to determine which message to send
-    global DB_PATH
-    is_registered_user = is_registered(DB_PATH, update.effective_chat.id)
+    is_registered_user = is_registered(update.effective_chat.id)
     if is_registered_user is True:
         msg = "Welcome back. You are a registered user of my stay-in-touch reminder service.\n" \
               "You can type /help in order to find out by which commands you can interact with me."
@@ -128,7 +1773,10 @@ def help(update, context):
           "/activate - (Re)Activates the reminder. Afterwards you will get a reminder every day\n" \
           "/deactivate - Deactives daily reminders for your chat ID\n" \
           "/time - Allows to set a new daily reminder time\n" \
-          "/remindme - Immediately sends the due contacts reminder\n"
+          "/remindme - Immediately sends the due contacts reminder\n" \
+          "/export - Sends all of your contacts as CSV file, /export jsonl as JSON Lines\n" \
+          "You can also send me a CSV file (first_name, last_name, interval in days, last contact as " \
+          "YYYY-MM-DD) or a vCard file to import many contacts at once.\n"
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=msg)
 
@@ -136,26 +1784,25 @@ def help(update, context):
 # activate command to set the is_active flag for a user to true/1
 def activate(update, context):
     # determine if user is registered and set is_active to 1
-    global DB_PATH
-    if is_registered(DB_PATH, update.effective_chat.id):
-        # update database
-        sql = ''' UPDATE users SET is_active = ? WHERE chat_id = ?'''
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        cur.execute(sql, (1, update.effective_chat.id))
-        db.commit()
+    try:
+        user = lookup_user(update.effective_chat.id)
+        if user is not None:
+            # update database
+            sql = ''' UPDATE users SET is_active = ? WHERE chat_id = ?'''
+            db_for(update.effective_chat.id).execute(sql, (1, update.effective_chat.id)).result()
+    except sqlite3.Error as e:
+        logger.error("Could not activate the reminders", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not activate your reminders. Please "
+                                      "try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    if user is not None:
+        user_cache.put(update.effective_chat.id, user._replace(is_active=1))
         # update the job
-        # retrieve all jobs having the chat_id as name
-        current_jobs = context.job_queue.get_jobs_by_name(str(update.effective_chat.id))
-        # current_jobs is a tuple which should ideally only have one item. Enable it
-        for job in current_jobs:
-            job.enabled = True
-        # query reminder time value for reply message to user
-        sql = ''' SELECT reminder_time FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        reminder_time = cur.fetchone()[0]
+        set_reminder_enabled(context.job_queue, update.effective_chat.id, True)
         msg = "Daily reminders at {} have been activated. To deactivate them use " \
-              "the /deactivate command".format(reminder_time)
+              "the /deactivate command".format(user.reminder_time)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=msg,
                                  reply_markup=telegram.ReplyKeyboardRemove())
@@ -169,25 +1816,25 @@ def activate(update, context):
 # deactivate command to set the is_active flag for a user to false/0
 def deactivate(update, context):
     # determine if user is registered and set is_active to 1
-    global DB_PATH
-    if is_registered(DB_PATH, update.effective_chat.id):
-        # update database
-        sql = ''' UPDATE users SET is_active = ? WHERE chat_id = ?'''
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        cur.execute(sql, (0, update.effective_chat.id))
-        db.commit()
-        # retrieve all jobs having the chat_id as name
-        current_jobs = context.job_queue.get_jobs_by_name(str(update.effective_chat.id))
-        # current_jobs is a tuple which should ideally only have one item. Disable it
-        for job in current_jobs:
-            job.enabled = False
-        # query reminder time value for reply message to user
-        sql = ''' SELECT reminder_time FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        reminder_time = cur.fetchone()[0]
+    try:
+        user = lookup_user(update.effective_chat.id)
+        if user is not None:
+            # update database
+            sql = ''' UPDATE users SET is_active = ? WHERE chat_id = ?'''
+            db_for(update.effective_chat.id).execute(sql, (0, update.effective_chat.id)).result()
+    except sqlite3.Error as e:
+        logger.error("Could not deactivate the reminders", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not deactivate your reminders. Please "
+                                      "try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    if user is not None:
+        user_cache.put(update.effective_chat.id, user._replace(is_active=0))
+        # update the job
+        set_reminder_enabled(context.job_queue, update.effective_chat.id, False)
         msg = "Daily reminders at {} have been deactivated. To activate them use " \
-              "the /activate command".format(reminder_time)
+              "the /activate command".format(user.reminder_time)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=msg,
                                  reply_markup=telegram.ReplyKeyboardRemove())
@@ -211,17 +1858,9 @@ def cancel(update, context) -> int:
 def register(update, context) -> int:
     # query database for chat id to see if chat_id is registered already
     chat_id = update.effective_chat.id
-    global DB_PATH
-    db = connect_database(DB_PATH)
-    sql = ''' SELECT user_id FROM users WHERE chat_id = ?'''
-    try:
-        cur = db.cursor()
-        cur.execute(sql, (chat_id,))
-        is_registered_user = True if cur.fetchone() is not None else False
-    except sqlite3.Error as e:
-        print(e)
+    is_registered_user = is_registered(chat_id)
+    if is_registered_user is None:
         return ConversationHandler.END
-    db.close()
     # if user is registered already, user cannot be registered again
     if is_registered_user:
         context.bot.send_message(chat_id=update.effective_chat.id,
@@ -256,20 +1895,20 @@ def reminder_time(update, context) -> int:
         return 0
     # if conversion was successful, we have all necessary data to add the user with his chat_id to
     # the users table
-    sql = '''INSERT INTO users (chat_id, is_active, reminder_time) VALUES (?,?,?)'''
-    try:
-        global DB_PATH
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        cur.execute(sql, (update.effective_chat.id, 1, update.message.text))
-        db.commit()
-        db.close()
+    sql = '''INSERT INTO users (chat_id, is_active, reminder_time, reminder_minute) VALUES (?,?,?,?)'''
+    try:
+        cur = db_for(update.effective_chat.id).execute(sql, (update.effective_chat.id, 1, update.message.text,
+                                        minute_of_day(update.message.text))).result()
+        user_cache.put(update.effective_chat.id, UserEntry(cur.lastrowid, 1, update.message.text))
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not register the user", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong. I could not add you to the database. Please "
                                       "try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
+        return ConversationHandler.END
+    # make sure the new user gets reminded from today on
+    schedule_reminder(context.job_queue, update.effective_chat.id, update.message.text, True)
 
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text='Ok, that is all I need for now. I added you to the database. You can always '
@@ -280,8 +1919,7 @@ def reminder_time(update, context) -> int:
 
 # edit reminder time conversation
 def edit_reminder_time_start(update, context) -> int:
-    global DB_PATH
-    if is_registered(DB_PATH, update.effective_chat.id):
+    if is_registered(update.effective_chat.id):
         msg = "Sure, let's update your reminder time. Things in life can change. Please tell me your new " \
               "desired reminder time in HH:MM:SS format."
         context.bot.send_message(chat_id=update.effective_chat.id,
@@ -308,20 +1946,23 @@ def edit_reminder_time_end(update, context) -> int:
                                  reply_markup=telegram.ReplyKeyboardRemove())
         return 0
     # if converting was successful, we can update the database
-    sql = ''' UPDATE users SET reminder_time= ? WHERE chat_id = ?'''
-    global DB_PATH
-    db = connect_database(DB_PATH)
-    cur = db.cursor()
-    cur.execute(sql, (update.message.text, update.effective_chat.id))
-    db.commit()
-    db.close()
-    global jobs
-    global TIMEZONE
-    reminder_datetime_tz = reminder_datetime.time().replace(tzinfo=pytz.timezone(TIMEZONE))
-    jobs[update.effective_chat.id] = context.job_queue.run_daily(reminder, time=reminder_datetime_tz,
-                                                                 context=update.effective_chat.id,
-                                                                 name=str(update.effective_chat.id))
-    # we also need to change the scheduled time in the job itself
+    try:
+        user = lookup_user(update.effective_chat.id)
+        sql = ''' UPDATE users SET reminder_time= ?, reminder_minute = ? WHERE chat_id = ?'''
+        db_for(update.effective_chat.id).execute(sql, (update.message.text, minute_of_day(update.message.text),
+                                                       update.effective_chat.id)).result()
+    except sqlite3.Error as e:
+        logger.error("Could not update the reminder time", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not change your reminder time. Please "
+                                      "try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return ConversationHandler.END
+    user_cache.invalidate(update.effective_chat.id)
+    # we also need to change the scheduled time in the job itself, which replaces the old job and keeps
+    # deactivated reminders deactivated
+    schedule_reminder(context.job_queue, update.effective_chat.id, update.message.text,
+                      user is None or user.is_active != 0)
     msg = "Done! From now on you will receive reminders at {}".format(update.message.text)
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text=msg,
@@ -331,8 +1972,7 @@ def edit_reminder_time_end(update, context) -> int:
 
 # new contact conversation
 def new_contact(update, context) -> int:
-    global DB_PATH
-    if not is_registered(DB_PATH, update.effective_chat.id):
+    if not is_registered(update.effective_chat.id):
         msg = "You are not a registered user. Please register first using the /register command"
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=msg,
@@ -342,12 +1982,15 @@ def new_contact(update, context) -> int:
                              text="Ok. Let's add a new contact to your reminder database.\n"
                                   "What is his or her first name?",
                              reply_markup=telegram.ReplyKeyboardRemove())
+    # the data of the conversation is collected per chat, so that conversations of different chats
+    # can run concurrently
+    context.chat_data["new_contact"] = {}
     # FIRST_NAME = 0
     return 0
 
 
 def first_name(update, context) -> int:
-    global sql_dict
+    sql_dict = context.chat_data.setdefault("new_contact", {})
     first_name = update.message.text
     sql_dict["first_name"] = first_name.strip()
     context.bot.send_message(chat_id=update.effective_chat.id,
@@ -361,7 +2004,7 @@ def first_name(update, context) -> int:
 
 
 def last_name(update, context) -> int:
-    global sql_dict
+    sql_dict = context.chat_data.setdefault("new_contact", {})
     last_name = update.message.text
     sql_dict["last_name"] = last_name.strip()
     context.bot.send_message(chat_id=update.effective_chat.id,
@@ -374,7 +2017,7 @@ def last_name(update, context) -> int:
 
 
 def skip_last_name(update, context) -> int:
-    global sql_dict
+    sql_dict = context.chat_data.setdefault("new_contact", {})
     sql_dict["last_name"] = ""
     context.bot.send_message(chat_id=update.effective_chat.id,
                              text="Ok, let's skip the last name and just call your contact {}.\n"
@@ -386,11 +2029,11 @@ def skip_last_name(update, context) -> int:
 
 
 def interval(update, context) -> int:
-    global sql_dict, DB_PATH
+    sql_dict = context.chat_data.setdefault("new_contact", {})
     try:
         interval = int(365 / int(update.message.text))
     except Exception as ex:
-        print(ex)
+        logger.info("Invalid interval", extra={"error": str(ex)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="You entered {}. But I asked you how often per year you want to get in "
                                       "touch with your contact. You have to enter a number. Let's try "
@@ -414,146 +2057,421 @@ def interval(update, context) -> int:
 
 
 def last_contact(update, context) -> int:
-    global sql_dict
+    sql_dict = context.chat_data.setdefault("new_contact", {})
     # try converting user input to datetime object
     try:
         last_contact_datetime = datetime.datetime.strptime(update.message.text, "%Y-%m-%d")
-    # if not successful set last_contact_datetime such that a reminder will be due today
+    # if not successful set last_contact_datetime such that a reminder will be due today in TIMEZONE
     except ValueError as e:
-        last_contact_datetime = datetime.datetime.now() - datetime.timedelta(days=sql_dict["interval"])
+        last_contact_datetime = datetime.date.fromordinal(today_day() - sql_dict["interval"])
     # set value in dictionary
     sql_dict["last_contact"] = last_contact_datetime.strftime('%Y_%m_%d')
     try:
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        sql = ''' SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You don't seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return
         else:
-            sql_dict["user_id"] = result[0]
-        # check if a row with this contact name already exists
-        sql = '''SELECT contact_id FROM contacts WHERE first_name = ? AND last_name = ? AND user_id = ?'''
-        cur.execute(sql, (sql_dict["first_name"], sql_dict["last_name"], sql_dict["last_name"]))
-        query_result = cur.fetchall()
+            sql_dict["user_id"] = user.user_id
+        # the duplicate check and the insert run as one task on the writer thread
+        added = db_for(update.effective_chat.id).write(add_contact, sql_dict["first_name"], sql_dict["last_name"],
+                                                       sql_dict["interval"], sql_dict["last_contact"],
+                                                       sql_dict["user_id"]).result()
         # if the row already exists inform the user and do nothing more
-        if len(query_result) > 0:
+        if not added:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="A contact with name {} {} already exists for this user. You cannot "
                                           "add a contact more than once. Quitting ...",
                                      reply_markup=telegram.ReplyKeyboardRemove())
-        # if the row does not exist, add it to the database and inform the user
+        # if the row did not exist, it has been added to the database so inform the user
         else:
-            sql = '''INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id) VALUES (?,?,?,?,?)'''
-            sql_tuple = tuple(sql_dict.values())
-            cur.execute(sql, sql_tuple)
-            db.commit()
-            db.close()
-
+            # the new contact may be due today
+            due_lists.invalidate(update.effective_chat.id)
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="Done. {} {} has been added to your contact list"
                                      .format(sql_dict["first_name"], sql_dict["last_name"]),
                                      reply_markup=telegram.ReplyKeyboardRemove())
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not add the contact", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong. I could not add your contact to the database. "
                                       "Please try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
+    context.chat_data.pop("new_contact", None)
     return ConversationHandler.END
 
 
+# helper function for the database executor which adds a contact unless the user already has a contact
+# with that name. Returns whether the contact was added
+def add_contact(db, first_name, last_name, interval, last_contact, user_id):
+    # check if a row with this contact name already exists
+    sql = '''SELECT contact_id FROM contacts WHERE first_name = ? AND last_name = ? AND user_id = ?'''
+    if db.execute(sql, (first_name, last_name, user_id)).fetchone() is not None:
+        return False
+    sql = '''INSERT INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due)
+    VALUES (?,?,?,?,?,?)'''
+    db.execute(sql, (first_name, last_name, interval, last_contact, user_id, due_day(last_contact, interval)))
+    sync_due_today(db, user_id, first_name, last_name)
+    return True
+
+
 # print contacts command
 def print_contacts(update, context):
-    global DB_PATH
-    try:
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        sql = '''SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+    try:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You don't seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return
         else:
-            user_id = result[0]
-        sql = ''' SELECT contact_id, first_name, last_name FROM contacts
-        WHERE user_id = ?'''
-        msg = ''
-        for row in cur.execute(sql, (user_id,)):
-            msg += "{}. {} {}\n".format(row[0], row[1], row[2])
+            user_id = user.user_id
+        # send the first page, the inline buttons below it page through the rest
+        msg, reply_markup = contacts_page(update.effective_chat.id, user_id, "next", 0)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=msg,
-                                 reply_markup=telegram.ReplyKeyboardRemove())
+                                 reply_markup=reply_markup)
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not print the contacts", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong. I could not add your contact to the database."
                                       "Please try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
 
 
+# callback of the inline buttons below a page of /printcontacts. The callback data has the form
+# "contacts:next:<contact_id>" or "contacts:prev:<contact_id>"
+def print_contacts_page(update, context):
+    query = update.callback_query
+    query.answer()
+    _, direction, contact_id = query.data.split(":")
+    try:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
+            return
+        msg, reply_markup = contacts_page(update.effective_chat.id, user.user_id, direction, int(contact_id))
+        query.edit_message_text(text=msg, reply_markup=reply_markup)
+    except sqlite3.Error as e:
+        logger.error("Could not page the contacts", extra={"error": str(e)})
+    except telegram.error.BadRequest as e:
+        # e.g. the page did not change because the same button was pressed twice
+        logger.info("Could not edit the page of contacts", extra={"error": str(e)})
+
+
+# helper function which returns the text and inline keyboard of one page of a user's contacts. The page
+# holds the contacts after contact_id for direction "next" and the contacts before contact_id for "prev".
+# It is found with a keyset query, so every page costs one bounded index range scan
+def contacts_page(chat_id, user_id, direction, contact_id):
+    # one more row than the page size tells whether there is another page in that direction
+    if direction == "prev":
+        sql = ''' SELECT contact_id, first_name, last_name FROM contacts
+        WHERE user_id = ? AND contact_id < ? ORDER BY contact_id DESC LIMIT ?'''
+    else:
+        sql = ''' SELECT contact_id, first_name, last_name FROM contacts
+        WHERE user_id = ? AND contact_id > ? ORDER BY contact_id LIMIT ?'''
+    rows = db_for(chat_id).query(sql, (user_id, contact_id, PRINT_CONTACTS_PAGE_SIZE + 1)).result()
+    more = len(rows) > PRINT_CONTACTS_PAGE_SIZE
+    rows = rows[:PRINT_CONTACTS_PAGE_SIZE]
+    if direction == "prev":
+        rows.reverse()
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = contact_id > 0, more
+    if not rows:
+        # all contacts in that direction have been deleted meanwhile, so start over
+        if contact_id > 0:
+            return contacts_page(chat_id, user_id, "next", 0)
+        return "You don't have any contacts yet. You can add one with the /newcontact command.", None
+    msg = ''
+    for row in rows:
+        msg += "{}. {} {}\n".format(row[0], row[1], row[2])
+    buttons = []
+    if has_previous:
+        buttons.append(telegram.InlineKeyboardButton("< Previous", callback_data="contacts:prev:{}".format(rows[0][0])))
+    if has_next:
+        buttons.append(telegram.InlineKeyboardButton("Next >", callback_data="contacts:next:{}".format(rows[-1][0])))
+    return msg, telegram.InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+@timed_job
 def reminder(context: telegram.ext.CallbackContext) -> None:
     # retrieve contacts of user
     # chat_id is passed as context of the job so it can be accessed as
     chat_id = context.job.context
-    global DB_PATH
-    due_contacts = []
     try:
         # get user_id which belongs to chat_id
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        sql = '''SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (chat_id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(chat_id)
+        if user is None:
             context.bot.send_message(chat_id=chat_id,
                                      text="You don't seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return
         else:
-            user_id = result[0]
+            user_id = user.user_id
 
-        # get list of contacts with all data
-        sql = '''SELECT first_name, last_name, interval, last_contact FROM
-        contacts WHERE user_id = ?'''
-        msg = "Hi there. Here is today's list of people who you want to stay in touch with:\n"
-        ii = 1
-        # determine for which contacts contacting is overdue
-        for row in cur.execute(sql, (user_id,)):
-            interval = row[2]
-            last_contact = datetime.datetime.strptime(row[3], '%Y_%m_%d')
-            if (last_contact + datetime.timedelta(days=interval)).date() <= datetime.date.today():
-                # append contacts to due_contacts list and
-                due_contacts.append(row[0] + ' ' + row[1])
-                msg += "{}: {} {}\n".format(ii, row[0], row[1])
-                ii += 1
-        db.close()
+        # get list of contacts for which contacting is overdue
+        today = today_day()
+        due_contacts = query_due_contacts(chat_id, user_id, today)
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not query the due contacts", extra={"chat_id": chat_id, "error": str(e)})
         context.bot.send_message(chat_id=chat_id,
                                  text="Oops. Something went wrong when retrieving your list of contacts.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
         return
+    due_lists.put(chat_id, today, due_contacts)
+    send_reminder(reminder_sender(context), chat_id, due_contacts)
+
+
+# helper function to send the reminder message for a list of due contacts ("first_name last_name").
+# bot can be a telegram.Bot or an OutboundQueue
+def send_reminder(bot, chat_id, due_contacts):
     # check if there are due contacts and only send a reminder if that is the case
     if len(due_contacts) > 0:
+        msg = "Hi there. Here is today's list of people who you want to stay in touch with:\n"
+        for ii, name in enumerate(due_contacts, start=1):
+            msg += "{}: {}\n".format(ii, name)
         # send a message to the user with his due contacts and offer him a keyboard to mark users which have
         # been contacted
         custom_keyboard = [['I contacted ' + name + ' today!'] for name in due_contacts]
         custom_keyboard.append(["Nope, that's it for today"])
-        context.bot.send_message(chat_id=chat_id,
-                                 text=msg,
-                                 reply_markup=telegram.ReplyKeyboardMarkup(custom_keyboard,
-                                                                           one_time_keyboard=True))
+        bot.send_message(chat_id=chat_id,
+                         text=msg,
+                         reply_markup=telegram.ReplyKeyboardMarkup(custom_keyboard,
+                                                                   one_time_keyboard=True))
+
+
+# job for the bucketed scheduler which reminds all active users whose reminder time falls
+# into the minute of the day passed as context of the job
+@timed_job
+def reminder_bucket(context: telegram.ext.CallbackContext) -> None:
+    minute = context.job.context
+    today = today_day()
+    if reminder_pool is not None:
+        remind_bucket_in_pool(context, minute, today)
+        return
+    # one query per shard returns the due contacts of all users in the bucket, ordered so that they can be
+    # grouped by chat
+    for shard in range(DB_SHARDS):
+        remind_bucket_in_process(context, minute, today, shard)
+
+
+# helper function which queries the due contacts of a minute bucket, or of one partition of it, on a shard in
+# the bot process and sends the reminders
+def remind_bucket_in_process(context, minute, today, shard, partition=0, partitions=1):
+    sql, params = bucket_due_query(minute, today, due_today_day == today, partition, partitions)
+    try:
+        rows = db_shards[shard].query(sql, params, batch=True).result()
+    except sqlite3.Error as e:
+        logger.error("Could not query the due contacts of the bucket",
+                     extra={"minute": minute, "shard": shard, "error": str(e)})
+        return
+    send_grouped_reminders(context, rows, today)
+
+
+# helper function returning the statement and parameters which select (chat_id, first_name, last_name) of the
+# due contacts of the active users in a minute bucket on day, ordered so that they can be grouped by chat.
+# With partitions > 1 only the users whose user_id % partitions equals partition are selected
+def bucket_due_query(minute, day, use_due_today, partition=0, partitions=1):
+    if use_due_today:
+        sql = '''SELECT users.chat_id, due_today.first_name, due_today.last_name FROM users
+        JOIN due_today ON due_today.user_id = users.user_id
+        WHERE users.reminder_minute = ? AND users.is_active = 1{}
+        ORDER BY users.user_id, due_today.contact_id'''
+        params = (minute,)
+    else:
+        sql = '''SELECT users.chat_id, contacts.first_name, contacts.last_name FROM users
+        JOIN contacts ON contacts.user_id = users.user_id
+        WHERE users.reminder_minute = ? AND users.is_active = 1 AND contacts.next_due <= ?{}
+        ORDER BY users.user_id, contacts.contact_id'''
+        params = (minute, day)
+    if partitions > 1:
+        return sql.format(" AND users.user_id % ? = ?"), params + (partitions, partition)
+    return sql.format(""), params
+
+
+# helper function which computes the due contacts of a minute bucket on the reminder_pool and sends the
+# reminders as the partitions complete. Every shard is split into REMINDER_PROCESSES partitions. Partitions
+# which the pool fails to compute are queried in the bot process instead, and a broken pool is given up so
+# that the following buckets are computed in the bot process right away
+def remind_bucket_in_pool(context, minute, today):
+    global reminder_pool
+    use_due_today = due_today_day == today
+    futures = {}
+    failed = []
+    broken = False
+    for shard in range(DB_SHARDS):
+        for partition in range(REMINDER_PROCESSES):
+            try:
+                future = reminder_pool.submit(compute_bucket_partition, shard, minute, today, use_due_today,
+                                              partition, REMINDER_PROCESSES)
+            except (RuntimeError, concurrent.futures.BrokenExecutor) as e:
+                logger.error("Could not start the reminder computation", extra={"minute": minute, "error": str(e)})
+                failed.append((shard, partition))
+                broken = True
+                continue
+            futures[future] = (shard, partition)
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            due = future.result()
+        except (sqlite3.Error, OSError, concurrent.futures.BrokenExecutor) as e:
+            logger.error("Could not compute the due contacts of the bucket, querying them in the bot process",
+                         extra={"minute": minute, "shard": futures[future][0], "error": str(e)})
+            failed.append(futures[future])
+            broken = broken or isinstance(e, concurrent.futures.BrokenExecutor)
+            continue
+        for chat_id, due_contacts in due:
+            due_lists.put(chat_id, today, due_contacts)
+            send_reminder(reminder_sender(context), chat_id, due_contacts)
+    if broken and reminder_pool is not None:
+        logger.error("The reminder workers broke down, reminders are computed in the bot process",
+                     extra={"minute": minute})
+        reminder_pool, pool = None, reminder_pool
+        pool.shutdown(wait=False)
+    for shard, partition in failed:
+        remind_bucket_in_process(context, minute, today, shard, partition, REMINDER_PROCESSES)
+
+
+# helper function which sends the reminders for rows of (chat_id, first_name, last_name) grouped by chat
+def send_grouped_reminders(context, rows, today):
+    for chat_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        due_contacts = [row[1] + ' ' + row[2] for row in group]
+        due_lists.put(chat_id, today, due_contacts)
+        send_reminder(reminder_sender(context), chat_id, due_contacts)
+
+
+# job for the wheel scheduler which runs every second and reminds the active users whose reminder time
+# has passed since its previous run. The due contacts are queried for up to 500 chats of a shard at once
+@timed_job
+def reminder_wheel_tick(context: telegram.ext.CallbackContext) -> None:
+    chat_ids = reminder_wheel.advance(datetime.datetime.now(LOCAL_TZ))
+    if not chat_ids:
+        return
+    today = today_day()
+    by_shard = collections.defaultdict(list)
+    for chat_id in chat_ids:
+        by_shard[shard_index(chat_id, DB_SHARDS)].append(chat_id)
+    chunks = [(shard, shard_chat_ids[start:start + 500]) for shard, shard_chat_ids in by_shard.items()
+              for start in range(0, len(shard_chat_ids), 500)]
+    for shard, chunk in chunks:
+        placeholders = ",".join("?" * len(chunk))
+        if due_today_day == today:
+            sql = '''SELECT users.chat_id, due_today.first_name, due_today.last_name FROM users
+            JOIN due_today ON due_today.user_id = users.user_id
+            WHERE users.chat_id IN ({}) AND users.is_active = 1
+            ORDER BY users.user_id, due_today.contact_id'''.format(placeholders)
+            params = chunk
+        else:
+            sql = '''SELECT users.chat_id, contacts.first_name, contacts.last_name FROM users
+            JOIN contacts ON contacts.user_id = users.user_id
+            WHERE users.chat_id IN ({}) AND users.is_active = 1 AND contacts.next_due <= ?
+            ORDER BY users.user_id, contacts.contact_id'''.format(placeholders)
+            params = chunk + [today]
+        try:
+            rows = db_shards[shard].query(sql, params, batch=True).result()
+        except sqlite3.Error as e:
+            logger.error("Could not query the due contacts of the wheel",
+                         extra={"chats": len(chunk), "shard": shard, "error": str(e)})
+            continue
+        send_grouped_reminders(context, rows, today)
+
+
+# helper function to make sure that the reminder of a user is scheduled at reminder_time (HH:MM:SS).
+# In per_user mode this creates a daily job for the chat, in bucketed mode it creates the job for the
+# minute bucket if no other user needed it so far, in wheel mode it puts the chat into the reminder wheel.
+# With replace=False an existing job of the chat is kept
+def schedule_reminder(job_queue, chat_id, reminder_time, is_active, replace=True):
+    global jobs, bucket_jobs
+    if SCHEDULER_MODE == "wheel":
+        time_of_day = local_time_of_day(reminder_time)
+        reminder_wheel.schedule(chat_id, time_of_day.hour * 3600 + time_of_day.minute * 60 + time_of_day.second,
+                                is_active, replace)
+        return
+    if SCHEDULER_MODE == "bucketed":
+        minute = minute_of_day(reminder_time)
+        with schedule_lock:
+            if minute not in bucket_jobs:
+                # replace timezone as PTB needs timezone-aware objects
+                bucket_time = datetime.time(minute // 60, minute % 60, tzinfo=LOCAL_TZ)
+                bucket_jobs[minute] = job_queue.run_daily(reminder_bucket, time=bucket_time, context=minute,
+                                                          name="bucket_{}".format(minute))
+        return
+    reminder_datetime_tz = local_time_of_day(reminder_time)
+    with schedule_lock:
+        old_job = jobs.get(chat_id)
+        if old_job is not None:
+            if not replace:
+                return
+            # the old job would keep reminding the chat at its previous time
+            old_job.schedule_removal()
+        jobs[chat_id] = job_queue.run_daily(reminder, time=reminder_datetime_tz, context=chat_id,
+                                            name=str(chat_id))
+        # disable job right away if is_active is False (i.e. == 0)
+        if not is_active:
+            jobs[chat_id].enabled = False
+
+
+# helper function which schedules the reminders of all registered users at startup. The users of every shard
+# are read in batches of STARTUP_BATCH_SIZE ordered by user_id, so neither the whole table is held in memory
+# nor a read transaction is kept open while the jobs are created. Chats which a handler scheduled meanwhile
+# are kept
+def schedule_all_reminders(job_queue):
+    start = time.perf_counter()
+    rows_read = 0
+    try:
+        if SCHEDULER_MODE == "bucketed":
+            # one job per distinct minute of the day instead of one job per user
+            sql = ''' SELECT DISTINCT reminder_minute FROM users'''
+            minutes = {row[0] for rows in query_all_shards(sql) for row in rows}
+            for minute in sorted(minutes):
+                schedule_reminder(job_queue, None, "{:02d}:{:02d}:00".format(minute // 60, minute % 60), True)
+            rows_read = len(minutes)
+        else:
+            sql = ''' SELECT user_id, chat_id, is_active, reminder_time FROM users WHERE user_id > ?
+                      ORDER BY user_id LIMIT ?'''
+            for executor in db_shards:
+                last_user_id = -1
+                while True:
+                    rows = executor.query(sql, (last_user_id, STARTUP_BATCH_SIZE), batch=True).result()
+                    for row in rows:
+                        schedule_reminder(job_queue, row[1], row[3], row[2] != 0, replace=False)
+                    rows_read += len(rows)
+                    if len(rows) < STARTUP_BATCH_SIZE:
+                        break
+                    last_user_id = rows[-1][0]
+    except sqlite3.Error as e:
+        logger.error("Could not schedule the reminders", extra={"error": str(e)})
+        return
+    logger.info("Scheduled the reminders", extra={"rows": rows_read,
+                                                  "jobs": len(jobs) + len(bucket_jobs) + len(reminder_wheel),
+                                                  "duration": round(time.perf_counter() - start, 3)})
+
+
+# helper function which schedules the reminders of all users on a background thread, so that the bot serves
+# updates right away instead of after the whole users table was read
+def start_scheduling_reminders(job_queue):
+    thread = threading.Thread(target=schedule_all_reminders, args=(job_queue,), name="schedule_reminders",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+# helper function to enable or disable the daily reminder of a chat. The bucketed jobs
+# read is_active from the database, so only per_user jobs and wheel entries need to be touched
+def set_reminder_enabled(job_queue, chat_id, enabled):
+    if SCHEDULER_MODE == "bucketed":
+        return
+    if SCHEDULER_MODE == "wheel":
+        reminder_wheel.set_enabled(chat_id, enabled)
+        return
+    with schedule_lock:
+        job = jobs.get(chat_id)
+        if job is not None:
+            job.enabled = enabled
 
 
 # function to be called after a user has contacted a contact and send the
@@ -566,42 +2484,41 @@ def last_contact_update(update, context):
     last_name = splitted[-2]
 
     # try to update the last_contact value of the contact in the contacts table
-    global DB_PATH
     try:
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
         # first get the user_id from the chat_id
-        sql = '''SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You don't seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return
         else:
-            user_id = result[0]
-        # first determine if there is a first_name last_name record for that user_id in the contacts table
-        sql = '''SELECT contact_id FROM contacts WHERE first_name = ? AND last_name = ? AND user_id = ?'''
-        cur.execute(sql, (first_name, last_name, user_id))
-        query_result = cur.fetchall()
-        # if the record exists update the last_contact with todays date
-        if len(query_result) > 0:
-            sql = ''' UPDATE contacts SET last_contact = ? WHERE first_name = ? AND last_name = ? AND user_id = ?'''
-            cur.execute(sql, (datetime.datetime.now().strftime("%Y_%m_%d"), first_name, last_name, user_id))
-            db.commit()
-            # get list of contacts with all data to construct new reply keyboard
-            sql = '''SELECT first_name, last_name, interval, last_contact FROM
-            contacts WHERE user_id = ?'''
-            due_contacts = []
-            # determine for which contacts contacting is overdue
-            for row in cur.execute(sql, (user_id,)):
-                interval = row[2]
-                last_contact = datetime.datetime.strptime(row[3], '%Y_%m_%d')
-                if (last_contact + datetime.timedelta(days=interval)).date() <= datetime.date.today():
-                    # append contacts to due_contacts list and
-                    due_contacts.append(row[0] + ' ' + row[1])
+            user_id = user.user_id
+        # update the last_contact of the first_name last_name record for that user_id with todays date.
+        # If no row was changed, the record does not exist
+        today = today_day()
+        if last_contact_buffer is None:
+            changed = db_for(update.effective_chat.id).write(mark_contacted, user_id, first_name, last_name,
+                                                             today).result()
+        else:
+            # write-behind: only check that the contact exists, the buffer commits the update together with
+            # those of other chats within LAST_CONTACT_FLUSH_MS
+            sql = ''' SELECT count(*) FROM contacts WHERE first_name = ? AND last_name = ? AND user_id = ?'''
+            changed = db_for(update.effective_chat.id).query(sql, (first_name, last_name, user_id)).result()[0][0]
+            if changed > 0:
+                last_contact_buffer.add(update.effective_chat.id, user_id, first_name, last_name, today)
+        if changed > 0:
+            # the remaining due contacts for the new reply keyboard come from today's due list of the chat.
+            # Only if the chat has none, e.g. after a restart, they are queried and the due list is created
+            due_contacts = due_lists.mark_done(update.effective_chat.id, today, first_name + ' ' + last_name)
+            if due_contacts is None:
+                due_contacts = query_due_contacts(update.effective_chat.id, user_id, today)
+                if last_contact_buffer is not None:
+                    # contacts whose update is not committed yet are still due in the database
+                    pending = last_contact_buffer.pending_names(update.effective_chat.id, user_id)
+                    due_contacts = [name for name in due_contacts if name not in pending]
+                due_lists.put(update.effective_chat.id, today, due_contacts)
             # construct new keyboard
             custom_keyboard = [['I contacted ' + name + ' today!'] for name in due_contacts]
             custom_keyboard.append(["Nope, that's it for today"])
@@ -619,14 +2536,29 @@ def last_contact_update(update, context):
                                           "This might be an indicator that your database is corrupt. Please get in "
                                           "touch with your admin".format(first_name, last_name),
                                      reply_markup=telegram.ReplyKeyboardRemove())
-        db.close()
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not update the last contact", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Somehow I could not update your last contact date for this contact.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
 
 
+# helper function for the database executor which sets the last contact of a contact to day and takes it off
+# due_today. Returns the number of changed contacts
+def mark_contacted(db, user_id, first_name, last_name, day):
+    sql = ''' UPDATE contacts SET last_contact = ?, next_due = ? + interval
+    WHERE first_name = ? AND last_name = ? AND user_id = ?'''
+    cur = db.execute(sql, (datetime.date.fromordinal(day).strftime("%Y_%m_%d"), day, first_name, last_name, user_id))
+    sync_due_today(db, user_id, first_name, last_name)
+    return cur.rowcount
+
+
+# helper function for the database executor which applies a batch of (user_id, first_name, last_name, day)
+# updates of the LastContactBuffer in one transaction. Returns the number of changed contacts
+def mark_contacted_many(db, updates):
+    return sum(mark_contacted(db, *update) for update in updates)
+
+
 # function to be called after a user has replied that no contact was contacted today by typing
 # "Nope, that's it for today" via custom keyboard or in any other way
 def no_contacts_today(update, context):
@@ -661,31 +2593,25 @@ def edit_contact_name(update, context) -> int:
     [first, last] = update.message.text.split()
     # check if a database record exists
     try:
-        global DB_PATH
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
         # determine user_id from user table
-        sql = '''SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You do not seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return ConversationHandler.END
         else:
-            user_id = result[0]
+            user_id = user.user_id
         # check if the entered contact exists in the contact database for the user with user_id
         sql = '''SELECT contact_id, interval, last_contact FROM contacts WHERE 
         user_id = ? AND first_name = ? and last_name = ?'''
-        cur.execute(sql, (user_id, first, last))
+        rows = db_for(update.effective_chat.id).query(sql, (user_id, first, last)).result()
         # user_id, first_name and last_name are UNIQUE in contacts table so we can be sure
         # that we will only fetch one entry in case it exists in the first place
-        result = cur.fetchone()
-        db.close()
+        result = rows[0] if rows else None
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not query the contact", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong when querying your contact. Please try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
@@ -706,7 +2632,9 @@ def edit_contact_name(update, context) -> int:
                              text="Gotcha. Let's edit {} {}. How often per year do you want to "
                                   "contact him or her? Please enter an integer number.".format(first, last),
                              reply_markup=telegram.ReplyKeyboardRemove())
-    # save first and last name in the sql_dict so that we can user it later on in the conversation
+    # save first and last name in the conversation data of the chat so that we can use it later on in the
+    # conversation. It is kept per chat, so that conversations of different chats can run concurrently
+    sql_dict = context.chat_data["edit_contact"] = {}
     sql_dict["first_name"] = first
     sql_dict["last_name"] = last
     sql_dict["interval"] = interval
@@ -716,11 +2644,11 @@ def edit_contact_name(update, context) -> int:
 
 
 def edit_contact_interval(update, context) -> int:
-    global sql_dict, DB_PATH
+    sql_dict = context.chat_data.setdefault("edit_contact", {})
     try:
         interval = int(365 / int(update.message.text))
     except Exception as ex:
-        print(ex)
+        logger.info("Invalid interval", extra={"error": str(ex)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="You entered {}. But I asked you how often per year you want to get in "
                                       "touch with your contact. You have to enter a number. Let's try "
@@ -742,7 +2670,7 @@ def edit_contact_interval(update, context) -> int:
 
 
 def edit_contact_last_contact(update, context) -> int:
-    global sql_dict
+    sql_dict = context.chat_data.setdefault("edit_contact", {})
     # try converting user input to datetime object and if successful update sql_dict
     try:
         last_contact_datetime = datetime.datetime.strptime(update.message.text, "%Y-%m-%d")
@@ -754,40 +2682,43 @@ def edit_contact_last_contact(update, context) -> int:
                                  reply_markup=telegram.ReplyKeyboardRemove())
     # then update the database
     try:
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        sql = ''' SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You don't seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return
         else:
-            sql_dict["user_id"] = result[0]
-        sql = '''UPDATE contacts
-        SET interval = ?, last_contact = ?
-        WHERE user_id = ? AND first_name = ? and last_name = ?'''
-        cur.execute(sql, (sql_dict["interval"], sql_dict["last_contact"],
-                          sql_dict["user_id"], sql_dict["first_name"], sql_dict["last_name"]))
-        db.commit()
-        db.close()
+            sql_dict["user_id"] = user.user_id
+        db_for(update.effective_chat.id).write(edit_contact, sql_dict["user_id"], sql_dict["first_name"],
+                                               sql_dict["last_name"], sql_dict["interval"],
+                                               sql_dict["last_contact"]).result()
+        due_lists.invalidate(update.effective_chat.id)
 
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Done. {} {} has been updated"
                                  .format(sql_dict["first_name"], sql_dict["last_name"]),
                                  reply_markup=telegram.ReplyKeyboardRemove())
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not update the contact", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong. I could not update your contact. "
                                       "Please try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
+    context.chat_data.pop("edit_contact", None)
     return ConversationHandler.END
 
 
+# helper function for the database executor which updates interval and last contact of a contact
+def edit_contact(db, user_id, first_name, last_name, interval, last_contact):
+    sql = '''UPDATE contacts
+    SET interval = ?, last_contact = ?, next_due = ?
+    WHERE user_id = ? AND first_name = ? and last_name = ?'''
+    db.execute(sql, (interval, last_contact, due_day(last_contact, interval), user_id, first_name, last_name))
+    sync_due_today(db, user_id, first_name, last_name)
+
+
 # delete_contact conversation to delete one contact by name
 def delete_contact_start(update, context) -> int:
     context.bot.send_message(chat_id=update.effective_chat.id,
@@ -804,31 +2735,25 @@ def delete_contact_name(update, context) -> int:
     [first, last] = update.message.text.split()
     # check if a database record exists
     try:
-        global DB_PATH
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
         # determine user_id from user table
-        sql = '''SELECT user_id FROM users WHERE chat_id = ?'''
-        cur.execute(sql, (update.effective_chat.id,))
-        result = cur.fetchone()
-        if result is None:
+        user = lookup_user(update.effective_chat.id)
+        if user is None:
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="You do not seem to be a registered user. Please register "
                                           "first using the /register command.",
                                      reply_markup=telegram.ReplyKeyboardRemove())
             return ConversationHandler.END
         else:
-            user_id = result[0]
+            user_id = user.user_id
         # check if the entered contact exists in the contact database for the user with user_id
         sql = '''SELECT contact_id FROM contacts WHERE 
         user_id = ? AND first_name = ? and last_name = ?'''
-        cur.execute(sql, (user_id, first, last))
+        rows = db_for(update.effective_chat.id).query(sql, (user_id, first, last)).result()
         # user_id, first_name and last_name are UNIQUE in contacts table so we can be sure
         # that we will only fetch one entry in case it exists in the first place
-        result = cur.fetchone()
-        db.close()
+        result = rows[0] if rows else None
     except sqlite3.Error as e:
-        print(e)
+        logger.error("Could not query the contact", extra={"error": str(e)})
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Oops. Something went wrong when querying your contact. Please try again.",
                                  reply_markup=telegram.ReplyKeyboardRemove())
@@ -852,31 +2777,30 @@ def delete_contact_name(update, context) -> int:
                                   "Are you sure that you want to proceed.".format(first, last),
                              reply_markup=telegram.ReplyKeyboardMarkup(custom_keyboard,
                                                                        one_time_keyboard=True))
-    # save first and last name in the sql_dict so that we can user it later on in the conversation
+    # save first and last name in the conversation data of the chat so that we can use it later on in the
+    # conversation. It is kept per chat, so that conversations of different chats can run concurrently
+    sql_dict = context.chat_data["delete_contact"] = {}
     sql_dict["first_name"] = first
     sql_dict["last_name"] = last
     sql_dict["contact_id"] = int(contact_id)
+    sql_dict["user_id"] = user_id
     # point to delete_contact_confirmation
     return 1
 
 
 def delete_contact_confirmation(update, context) -> int:
-    global sql_dict, DB_PATH
+    sql_dict = context.chat_data.setdefault("delete_contact", {})
     # if the user replied with 'Yes, go ahead!' delete the row with contact_id
     if update.message.text == "Yes, go ahead!":
         try:
-            db = connect_database(DB_PATH)
-            cur = db.cursor()
-            sql = '''DELETE FROM contacts WHERE contact_id = ?'''
-            cur.execute(sql, (sql_dict["contact_id"],))
-            db.commit()
-            db.close()
+            db_for(update.effective_chat.id).write(delete_contact, sql_dict["user_id"], sql_dict["contact_id"]).result()
+            due_lists.invalidate(update.effective_chat.id)
             context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Done. {} {} has been deleted".format(sql_dict["first_name"],
                                                                             sql_dict["last_name"]),
                                  reply_markup=telegram.ReplyKeyboardRemove())
         except sqlite3.Error as e:
-            print(e)
+            logger.error("Could not delete the contact", extra={"error": str(e)})
             context.bot.send_message(chat_id=update.effective_chat.id,
                                      text="Oops, something went wrong when deleting your contact from the database",
                                      reply_markup=telegram.ReplyKeyboardRemove())
@@ -886,35 +2810,511 @@ def delete_contact_confirmation(update, context) -> int:
                                  text="I am happy that you made up your mind and want to keep {} {} "
                                       "as your contact".format(sql_dict["first_name"], sql_dict["last_name"]),
                                  reply_markup=telegram.ReplyKeyboardRemove())
+    context.chat_data.pop("delete_contact", None)
     return ConversationHandler.END
 
-# main function
-def main():
 
-    # INITIALIZE TELEGRAM BOT
-    # instantiate update and dispatcher and job queue
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
-    jobqueue = updater.job_queue
+# helper function for the database executor which deletes a contact together with its due_today row
+def delete_contact(db, user_id, contact_id):
+    db.execute('''DELETE FROM contacts WHERE contact_id = ?''', (contact_id,))
+    db.execute('''DELETE FROM due_today WHERE user_id = ? AND contact_id = ?''', (user_id, contact_id))
 
-    # INITIALIZE DATABASE
-    db = connect_database(DB_PATH)
-    # create the tables if they don't exist already
-    create_tables(db)
-    db.close()
 
+# REMINDER WORKERS
+# read-only connections of a reminder worker process, one per shard
+worker_dbs = []
+
+
+# initializer of the reminder worker processes, which opens a read-only connection to every shard
+def init_reminder_worker(db_paths, busy_timeout):
+    global worker_dbs
+    worker_dbs = [ConnectionManager(path, read_only=True, busy_timeout=busy_timeout).get() for path in db_paths]
+
+
+# function run in a reminder worker process which computes the due contacts of one partition of the users of
+# a minute bucket on a shard. Returns a list of (chat_id, list of "first_name last_name") of the users who have
+# due contacts, so that the bot process only has to send the messages
+def compute_bucket_partition(shard, minute, day, use_due_today, partition, partitions):
+    sql, params = bucket_due_query(minute, day, use_due_today, partition, partitions)
+    rows = worker_dbs[shard].execute(sql, params).fetchall()
+    return [(chat_id, [row[1] + ' ' + row[2] for row in group])
+            for chat_id, group in itertools.groupby(rows, key=lambda row: row[0])]
+
+
+# helper function which starts the process pool of the bucketed reminders. The workers are spawned instead of
+# forked, as the bot process already runs threads, and are started right away so that the first bucket
+# doesn't wait for them
+def start_reminder_pool(processes):
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_reminder_worker,
+        initargs=([shard_path(DB_PATH, ii, DB_SHARDS) for ii in range(DB_SHARDS)], DB_BUSY_TIMEOUT))
+    for future in [pool.submit(time.sleep, 0) for _ in range(processes)]:
+        future.result()
+    return pool
+
+
+# SHARD REBALANCING
+# helper function which copies the users and contacts of the databases at source_paths into new databases at
+# target_paths, putting every user into the shard of its chat_id. user_id and contact_id are numbered anew in
+# each target, due_today is left empty and rebuilt by the bot at its next start.
+# Returns the number of copied users and contacts
+def rebalance_shards(source_paths, target_paths, batch_size=10000):
+    targets = [sqlite3.connect(path) for path in target_paths]
+    users = contacts = 0
+    try:
+        for target in targets:
+            create_tables(target)
+        for source_path in source_paths:
+            source = sqlite3.connect(source_path)
+            try:
+                create_tables(source)
+                # all columns but the ids, so that columns of later migrations are copied as well
+                user_columns = [row[1] for row in source.execute("PRAGMA table_info(users)") if row[1] != "user_id"]
+                contact_columns = [row[1] for row in source.execute("PRAGMA table_info(contacts)")
+                                   if row[1] not in ("contact_id", "user_id")]
+                chat_id_index = user_columns.index("chat_id")
+                select_users = ''' SELECT user_id, {} FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?'''.format(
+                    ", ".join(user_columns))
+                select_contacts = ''' SELECT {} FROM contacts WHERE user_id = ? ORDER BY contact_id'''.format(
+                    ", ".join(contact_columns))
+                insert_user = ''' INSERT INTO users ({}) VALUES ({})'''.format(", ".join(user_columns),
+                                                                             ",".join("?" * len(user_columns)))
+                insert_contact = ''' INSERT INTO contacts ({}, user_id) VALUES ({})'''.format(
+                    ", ".join(contact_columns), ",".join("?" * (len(contact_columns) + 1)))
+                last_user_id = -1
+                while True:
+                    rows = source.execute(select_users, (last_user_id, batch_size)).fetchall()
+                    for row in rows:
+                        target = targets[shard_index(row[1 + chat_id_index], len(targets))]
+                        user_id = target.execute(insert_user, row[1:]).lastrowid
+                        contact_rows = [contact + (user_id,) for contact in source.execute(select_contacts, (row[0],))]
+                        target.executemany(insert_contact, contact_rows)
+                        contacts += len(contact_rows)
+                    users += len(rows)
+                    for target in targets:
+                        target.commit()
+                    if len(rows) < batch_size:
+                        break
+                    last_user_id = rows[-1][0]
+            finally:
+                source.close()
+    finally:
+        for target in targets:
+            target.close()
+    return users, contacts
+
+
+# helper function which spreads the users of the from_shards databases of DB_PATH over to_shards databases.
+# The new databases are written next to the old ones first, the old ones are then kept with the suffix
+# .<YYYYmmddHHMMSS>.bak, so the backups of earlier runs are never overwritten. The bot must be stopped while it
+# runs and DB_SHARDS set to to_shards afterwards
+def rebalance(from_shards, to_shards):
+    source_paths = [shard_path(DB_PATH, ii, from_shards) for ii in range(from_shards)]
+    missing = [path for path in source_paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError("missing shards: {}".format(", ".join(missing)))
+    # a write-ahead log exists while a connection is open, or after the bot crashed. Check before any source is
+    # opened, since opening migrates it
+    for path in source_paths:
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                raise RuntimeError("{} exists, the database is in use or the bot did not shut down cleanly. "
+                                   "Stop the bot, or start and stop it once, first".format(path + suffix))
+    backup_paths = ["{}.{}.bak".format(path, time.strftime("%Y%m%d%H%M%S")) for path in source_paths]
+    existing = [path for path in backup_paths if os.path.exists(path)]
+    if existing:
+        raise FileExistsError("backups exist already: {}".format(", ".join(existing)))
+    target_paths = [shard_path(DB_PATH, ii, to_shards) for ii in range(to_shards)]
+    temp_paths = [path + ".rebalance" for path in target_paths]
+    for path in temp_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    start = time.monotonic()
+    users, contacts = rebalance_shards(source_paths, temp_paths)
+    # closing the last connection has checkpointed and removed the write-ahead logs of the sources, a
+    # leftover log next to a target path would otherwise be applied to the new database. One shows up if the
+    # bot was started during the rebalance
+    for path in source_paths:
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                raise RuntimeError("{} is still in use, stop the bot first".format(path + suffix))
+    for path, backup_path in zip(source_paths, backup_paths):
+        os.replace(path, backup_path)
+    for temp_path, path in zip(temp_paths, target_paths):
+        os.replace(temp_path, path)
+    return {"users": users, "contacts": contacts, "seconds": time.monotonic() - start, "backups": backup_paths}
+
+
+# CONTACT IMPORT
+# helper function which yields (first_name, last_name, interval, last_contact) for every row of a CSV file.
+# The columns are first_name, last_name, interval in days and last contact as YYYY-MM-DD, in this order or
+# in the order of a header row naming them. Missing values are returned as None
+def parse_csv_contacts(lines):
+    columns = ["first_name", "last_name", "interval", "last_contact"]
+    for ii, row in enumerate(csv.reader(lines)):
+        if ii == 0 and "first_name" in [value.strip().lower() for value in row]:
+            columns = [value.strip().lower() for value in row]
+            continue
+        record = dict(zip(columns, row))
+        yield (record.get("first_name"), record.get("last_name"), record.get("interval"),
+               record.get("last_contact"))
+
+
+# helper function which yields (first_name, last_name, None, None) for every card of a vCard file. Only the
+# name is read, from the N property or else from FN
+def parse_vcard_contacts(lines):
+    card = None
+    for line in unfold_vcard_lines(lines):
+        name, _, value = line.partition(":")
+        key = name.split(";")[0].strip().upper()
+        if key == "BEGIN" and value.strip().upper() == "VCARD":
+            card = {}
+        elif key == "END" and card is not None:
+            if card.get("N"):
+                # N is family name;given name;additional names;prefixes;suffixes
+                parts = [part.replace("\\,", ",").strip() for part in card["N"].split(";")]
+                yield (parts[1] if len(parts) > 1 else ""), parts[0], None, None
+            elif card.get("FN"):
+                first, _, last = card["FN"].replace("\\,", ",").strip().rpartition(" ")
+                yield (first, last, None, None) if first else (last, "", None, None)
+            else:
+                yield None, None, None, None
+            card = None
+        elif card is not None and key in ("N", "FN"):
+            card[key] = value
+
+
+# helper function which joins folded vCard lines, i.e. lines continued on the next line after a space or tab
+def unfold_vcard_lines(lines):
+    pending = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and pending is not None:
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending is not None:
+        yield pending
+
+
+# helper function returning the import format of a file name or None
+def import_format(file_name):
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension in (".csv", ".txt"):
+        return "csv"
+    if extension in (".vcf", ".vcard"):
+        return "vcard"
+    return None
+
+
+# helper function for the database executor which inserts the parsed contacts of a user in one transaction.
+# records are consumed as they are parsed, so the file is never held in memory. Contacts which already exist
+# are skipped through the UNIQUE (first_name, last_name, user_id) constraint, invalid records are counted
+def import_contacts(db, user_id, records):
+    counts = {"read": 0, "invalid": 0}
+    today = today_day()
+
+    def rows():
+        for first, last, interval, last_contact in records:
+            counts["read"] += 1
+            try:
+                first = (first or "").strip()
+                if not first:
+                    raise ValueError("no first name")
+                interval = int(interval) if interval not in (None, "") else IMPORT_DEFAULT_INTERVAL
+                if interval <= 0:
+                    raise ValueError("interval must be positive")
+                if last_contact:
+                    last_contact_date = datetime.date.fromisoformat(last_contact.strip().replace("_", "-"))
+                else:
+                    # without a date the contact is due right away, like in the /newcontact conversation
+                    last_contact_date = datetime.date.fromordinal(today - interval)
+                # a huge interval puts the due day past the last date, or past any ordinal with OverflowError
+                next_due = datetime.date.fromordinal(last_contact_date.toordinal() + interval).toordinal()
+            except (ValueError, OverflowError):
+                counts["invalid"] += 1
+                continue
+            yield (first, (last or "").strip(), interval, last_contact_date.strftime("%Y_%m_%d"), user_id,
+                   next_due)
+
+    sql = '''INSERT OR IGNORE INTO contacts (first_name, last_name, interval, last_contact, user_id, next_due)
+    VALUES (?,?,?,?,?,?)'''
+    changes = db.total_changes
+    db.executemany(sql, rows())
+    imported = db.total_changes - changes
+    sync_due_today(db, user_id)
+    return {"read": counts["read"], "imported": imported, "invalid": counts["invalid"],
+            "duplicates": counts["read"] - counts["invalid"] - imported}
+
+
+# helper function which imports a CSV or vCard file, given as text file object, for a user and returns the
+# counts of import_contacts together with the duration and the number of rows per second
+def import_file(chat_id, user_id, text_file, file_format):
+    parse = parse_vcard_contacts if file_format == "vcard" else parse_csv_contacts
+    start = time.monotonic()
+    result = db_for(chat_id).write(import_contacts, user_id, parse(text_file)).result()
+    result["seconds"] = time.monotonic() - start
+    result["rows_per_second"] = result["read"] / result["seconds"] if result["seconds"] else 0.0
+    return result
+
+
+# function to be called when a user sends a document. CSV and vCard files are imported as contacts
+def import_document(update, context):
+    try:
+        user = lookup_user(update.effective_chat.id)
+    except sqlite3.Error as e:
+        logger.error("Could not import the contacts", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not import your contacts. "
+                                      "Please try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    if user is None:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="You don't seem to be a registered user. Please register "
+                                      "first using the /register command.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    document = update.message.document
+    file_format = import_format(document.file_name)
+    if file_format is None:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="I can only import contacts from CSV (.csv) and vCard (.vcf) files.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Sorry, this file is too large. I can import files of up to {} kB."
+                                 .format(IMPORT_MAX_FILE_SIZE // 1024),
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    try:
+        # the file is downloaded to disk and parsed while it is read, so it never has to fit into memory
+        with tempfile.TemporaryFile() as download:
+            context.bot.get_file(document.file_id).download(out=download)
+            download.seek(0)
+            result = import_file(update.effective_chat.id, user.user_id,
+                                 io.TextIOWrapper(download, encoding="utf-8-sig", newline=""), file_format)
+    except (sqlite3.Error, telegram.error.TelegramError, UnicodeDecodeError, csv.Error) as e:
+        logger.error("Could not import the contacts", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not import your contacts. "
+                                      "Please try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    # imported contacts may be due today
+    due_lists.invalidate(update.effective_chat.id)
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="Done. I imported {imported} of {read} contacts in {seconds:.2f}s "
+                                  "({rows_per_second:.0f} rows/s). {duplicates} of them already existed and "
+                                  "{invalid} could not be read.".format(**result),
+                             reply_markup=telegram.ReplyKeyboardRemove())
+
+
+# CONTACT EXPORT
+# helper function for the database executor which writes all contacts of a user to the text file object out,
+# as CSV with the columns read by the import or as JSON Lines. The rows are written while the cursor steps
+# through them, so memory use does not depend on the number of contacts. Returns the number of contacts
+def export_contacts(db, user_id, out, file_format):
+    sql = '''SELECT first_name, last_name, interval, last_contact FROM contacts WHERE user_id = ?
+    ORDER BY contact_id'''
+    columns = ["first_name", "last_name", "interval", "last_contact"]
+    writer = csv.writer(out) if file_format == "csv" else None
+    if writer is not None:
+        writer.writerow(columns)
+    count = 0
+    for first, last, interval, last_contact in db.execute(sql, (user_id,)):
+        # dates are exported as YYYY-MM-DD, like users enter them
+        row = [first, last, interval, last_contact.replace("_", "-") if last_contact else ""]
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            out.write(json.dumps(dict(zip(columns, row))) + "\n")
+        count += 1
+    return count
+
+
+# export command which sends all contacts of the user as CSV file, or as JSON Lines with /export jsonl
+def export(update, context):
+    try:
+        user = lookup_user(update.effective_chat.id)
+    except sqlite3.Error as e:
+        logger.error("Could not export the contacts", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not export your contacts. "
+                                      "Please try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    if user is None:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="You don't seem to be a registered user. Please register "
+                                      "first using the /register command.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+        return
+    file_format = "jsonl" if context.args and context.args[0].lower() in ("json", "jsonl") else "csv"
+    try:
+        # the contacts are streamed into a temporary file which is then uploaded
+        with tempfile.TemporaryFile() as export_file:
+            text_file = io.TextIOWrapper(export_file, encoding="utf-8", newline="")
+            count = db_for(update.effective_chat.id).read(export_contacts, user.user_id, text_file, file_format,
+                                                          batch=True).result()
+            text_file.flush()
+            text_file.detach()
+            export_file.seek(0)
+            context.bot.send_document(chat_id=update.effective_chat.id, document=export_file,
+                                      filename="contacts.{}".format(file_format),
+                                      caption="Here are your {} contacts.".format(count))
+    except (sqlite3.Error, telegram.error.TelegramError) as e:
+        logger.error("Could not export the contacts", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong. I could not export your contacts. "
+                                      "Please try again.",
+                                 reply_markup=telegram.ReplyKeyboardRemove())
+
+
+# admin command to change the profiling sample rate: /profile 0.05 profiles 5% of the handler and job calls,
+# /profile off stops profiling and /profile alone reports the current state
+def profile(update, context):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Sorry, this command is only available to admins.")
+        return
+    if context.args:
+        try:
+            rate = 0.0 if context.args[0].lower() == "off" else float(context.args[0])
+            if not 0 <= rate <= 1:
+                raise ValueError("rate must be between 0 and 1")
+        except ValueError:
+            context.bot.send_message(chat_id=update.effective_chat.id,
+                                     text="Please give the fraction of calls to profile between 0 and 1, "
+                                          "e.g. /profile 0.05, or /profile off.")
+            return
+        profiler.sample_rate = rate
+        logger.info("Profiling sample rate set to %s", rate)
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="Profiling {:.1%} of the handler and job calls, {} profiled so far. The stats "
+                                  "are written to {}".format(profiler.sample_rate, profiler.profiled,
+                                                             profiler.directory))
+
+
+# admin command which reports the number of users, active users and contacts of every shard
+def dbstats(update, context):
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Sorry, this command is only available to admins.")
+        return
+    sql = ''' SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM users WHERE is_active = 1),
+    (SELECT count(*) FROM contacts)'''
+    try:
+        counts = [rows[0] for rows in query_all_shards(sql)]
+    except sqlite3.Error as e:
+        logger.error("Could not count the users and contacts", extra={"error": str(e)})
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Oops. Something went wrong when counting the users.")
+        return
+    lines = ["shard {}: {} users ({} active), {} contacts".format(shard, *shard_counts)
+             for shard, shard_counts in enumerate(counts)]
+    if len(counts) > 1:
+        lines.append("total: {} users ({} active), {} contacts".format(*(sum(column) for column in zip(*counts))))
+    context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(lines))
+
+
+class SequentialConversationHandler(ConversationHandler):
+    """ ConversationHandler which keeps the updates of a conversation in order when the handlers run with
+        run_async. The plain ConversationHandler drops an update which arrives while the handler of the
+        previous update of the same conversation is still running on a worker thread, e.g. when a user
+        answers quickly. So the updates of every conversation are queued and a single worker thread per
+        conversation handles them one after another: an update is only matched against the conversation
+        state once the previous step is finished. The conversations of different chats run in parallel
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._handlers = self.entry_points + self.fallbacks + [handler for handlers in self.states.values()
+                                                               for handler in handlers]
+        # the steps run synchronously on the worker thread of their conversation
+        for handler in self._handlers:
+            handler.run_async = False
+        # conversation key -> deque of (update, context) not handled yet, the key is present while a worker
+        # thread handles the conversation
+        self._pending = {}
+        # update ids of updates which the conversation passed on to the other handlers
+        self._passed = set()
+        self._pending_lock = threading.Lock()
+
+    def check_update(self, update):
+        if isinstance(update, telegram.Update) and update.effective_chat and update.effective_user \
+                and not (update.channel_post or update.edited_channel_post):
+            key = self._get_key(update)
+            with self._pending_lock:
+                busy = key in self._pending and update.update_id not in self._passed
+                self._passed.discard(update.update_id)
+            if busy:
+                # the state after the running step is not known yet, so every update which the conversation
+                # might handle is queued behind it
+                if any(handler.check_update(update) not in (None, False) for handler in self._handlers):
+                    return key, None, None
+                return None
+        return super().check_update(update)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        key = check_result[0]
+        with self._pending_lock:
+            idle = key not in self._pending
+            self._pending.setdefault(key, collections.deque()).append((update, context))
+        if not idle:
+            return
+        if dispatcher.bot.defaults and dispatcher.bot.defaults.run_async:
+            dispatcher.run_async(self._handle_pending, key, dispatcher, update=update)
+        else:
+            self._handle_pending(key, dispatcher)
+
+    # helper function which handles the queued updates of a conversation until there are none left
+    def _handle_pending(self, key, dispatcher):
+        while True:
+            with self._pending_lock:
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    return
+                update, context = pending.popleft()
+            check = super().check_update(update)
+            if check is None:
+                # the previous step ended the conversation or left it in a state which does not take the
+                # update, so it goes back to the dispatcher for the other handlers
+                with self._pending_lock:
+                    self._passed.add(update.update_id)
+                dispatcher.update_queue.put(update)
+                continue
+            try:
+                super().handle_update(update, dispatcher, check, context)
+            except DispatcherHandlerStop:
+                pass
+            except Exception as e:
+                dispatcher.dispatch_error(update, e)
+
+
+# helper function which defines all handlers and adds them to the dispatcher
+def add_handlers(dispatcher):
     # define all the handlers except conversation handlers
     start_handler = CommandHandler('start', start)
     help_handler = CommandHandler('help', help)
     activate_handler = CommandHandler('activate', activate)
     deactivate_handler = CommandHandler('deactivate', deactivate)
     print_contacts_handler = CommandHandler('printcontacts', print_contacts)
+    print_contacts_page_handler = CallbackQueryHandler(print_contacts_page, pattern=r'^contacts:(next|prev):\d+$')
     last_contact_update_handler = MessageHandler(Filters.regex('I contacted \w+ \w+ today!'), last_contact_update)
     no_contacts_today_handler = MessageHandler(Filters.regex("Nope, that's it for today"), no_contacts_today)
     remindme_handler = CommandHandler('remindme', remindme)
+    import_handler = MessageHandler(Filters.document, import_document)
+    export_handler = CommandHandler('export', export)
+    profile_handler = CommandHandler('profile', profile)
+    dbstats_handler = CommandHandler('dbstats', dbstats)
 
     # define the conversation handlers
-    register_handler = ConversationHandler(
+    register_handler = SequentialConversationHandler(
         entry_points=[CommandHandler('register', register),
                       MessageHandler(Filters.regex(r'Please register me!'), register)],
         states={
@@ -922,14 +3322,14 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
-    edit_time_handler = ConversationHandler(
+    edit_time_handler = SequentialConversationHandler(
         entry_points=[CommandHandler('time', edit_reminder_time_start)],
         states={
             0: [MessageHandler(Filters.text, edit_reminder_time_end)]
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
-    new_contact_handler = ConversationHandler(
+    new_contact_handler = SequentialConversationHandler(
         entry_points=[CommandHandler('newcontact', new_contact)],
         states={
             FIRST_NAME: [MessageHandler(Filters.text, first_name)],
@@ -940,7 +3340,7 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
-    edit_contact_handler = ConversationHandler(
+    edit_contact_handler = SequentialConversationHandler(
         entry_points=[CommandHandler('editcontact', edit_contact_start)],
         states={
             0: [MessageHandler(Filters.text, edit_contact_name)],
@@ -949,7 +3349,7 @@ def main():
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
-    delete_contact_handler = ConversationHandler(
+    delete_contact_handler = SequentialConversationHandler(
         entry_points=[CommandHandler('deletecontact', delete_contact_start)],
         states={
             0: [MessageHandler(Filters.text, delete_contact_name)],
@@ -966,37 +3366,225 @@ def main():
     dispatcher.add_handler(edit_time_handler)
     dispatcher.add_handler(new_contact_handler)
     dispatcher.add_handler(print_contacts_handler)
+    dispatcher.add_handler(print_contacts_page_handler)
     dispatcher.add_handler(last_contact_update_handler)
     dispatcher.add_handler(no_contacts_today_handler)
     dispatcher.add_handler(remindme_handler)
+    dispatcher.add_handler(import_handler)
+    dispatcher.add_handler(export_handler)
+    dispatcher.add_handler(profile_handler)
+    dispatcher.add_handler(dbstats_handler)
     dispatcher.add_handler(edit_contact_handler)
     dispatcher.add_handler(delete_contact_handler)
+    instrument_handlers(dispatcher)
+    # log_error has to run on the thread of the failed handler, so it never runs asynchronously
+    dispatcher.add_error_handler(log_error, run_async=False)
+
+
+# helper function which wraps the callbacks of all handlers of the dispatcher, including the handlers of
+# the conversations, so that their latency is recorded in the metrics
+def instrument_handlers(dispatcher):
+    for group in dispatcher.handlers.values():
+        for handler in group:
+            if isinstance(handler, ConversationHandler):
+                handlers = handler.entry_points + handler.fallbacks + [state_handler for state_handlers in
+                                                                       handler.states.values()
+                                                                       for state_handler in state_handlers]
+            else:
+                handlers = [handler]
+            for inner in handlers:
+                inner.callback = timed_callback(inner.callback, "handler")
+
+
+# helper function which serves updates through the webhook listener until the process receives a stop
+# signal. The Updater only runs the dispatcher and the job queue, its own webhook server is not used
+def serve_webhook(updater):
+    if not WEBHOOK_URL:
+        logger.error("SERVING_MODE is webhook but no WEBHOOK_URL is configured")
+        return
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    listener = WebhookListener(updater.bot, updater.dispatcher.update_queue, host=WEBHOOK_LISTEN,
+                               port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, workers=WEBHOOK_WORKERS,
+                               max_body_size=WEBHOOK_MAX_BODY_SIZE).start()
+    # Telegram opens at most one connection per listener worker
+    updater.bot.set_webhook(url="{}/{}".format(WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH.strip("/")),
+                            max_connections=WEBHOOK_WORKERS)
+    logger.info("Bot is now listening for webhook updates", extra={"port": listener.address[1]})
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *args: stop.set())
+    while not stop.wait(1):
+        pass
+    listener.stop()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher_thread.join()
 
-    # add a jobs to the job queue for each registered user
-    try:
-        db = connect_database(DB_PATH)
-        cur = db.cursor()
-        sql = ''' SELECT chat_id, is_active, reminder_time FROM users'''
-        cur.execute(sql)
-        for ii, row in enumerate(cur.fetchall()):
-            reminder_datetime = datetime.datetime.strptime(row[2], '%H:%M:%S').time()
-            localtz = pytz.timezone(TIMEZONE)
-            # replace timezone as PTB needs timezone-aware objects
-            reminder_datetime_tz = reminder_datetime.replace(tzinfo=localtz)
-            jobs[row[0]] = jobqueue.run_daily(reminder, time=reminder_datetime_tz, context=row[0], name=str(row[0]))
-            #jobs.append(jobqueue.run_repeating(reminder, interval=5, first=2, context=row[0], name=str(row[0])))
-            # disable job right away if is_active is False (i.e. == 0)
-            if row[1] == 0:
-                jobs[row[0]].enabled = False
-    except sqlite3.Error as e:
-        print(e)
 
+# main function
+def main():
+    # log through a background thread, so that writing the log never delays the handlers
+    log_listener = setup_logging()
 
-    # START BOT
-    print("[INFO] Starting Bot")
-    updater.start_polling()
-    print("[INFO] Bot is now listening")
-    updater.idle()
+    # INITIALIZE TELEGRAM BOT
+    # instantiate update and dispatcher and job queue
+    # with run_async the handlers run on the worker threads of the dispatcher. They only keep per chat state
+    # in context.chat_data and use one database connection per thread, so updates of different chats
+    # can be handled concurrently
+    # the bot counts the messages it sends for the metrics. Its connection pool is sized like the one
+    # the Updater would create itself
+    bot = InstrumentedBot(TOKEN, base_url=BOT_API_URL, request=Request(con_pool_size=DISPATCHER_WORKERS + 4),
+                          defaults=Defaults(run_async=RUN_ASYNC))
+    updater = Updater(bot=bot, use_context=True, workers=DISPATCHER_WORKERS)
+    dispatcher = updater.dispatcher
+    jobqueue = updater.job_queue
+    # record how late the scheduler starts the jobs
+    jobqueue.scheduler.add_listener(job_event_listener(jobqueue.scheduler), EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, host=METRICS_LISTEN, port=METRICS_PORT).start()
+        logger.info("Serving metrics", extra={"port": metrics_server.address[1]})
+
+    # reminders are sent through a rate limited queue so that popular reminder times don't hit flood limits
+    global outbound_queue
+    outbound_queue = OutboundQueue(updater.bot, global_rate=OUTBOUND_GLOBAL_RATE,
+                                   chat_interval=OUTBOUND_CHAT_INTERVAL, max_retries=OUTBOUND_MAX_RETRIES,
+                                   max_size=OUTBOUND_MAX_QUEUE)
+    outbound_queue.start()
+    if STATS_REPORT_INTERVAL:
+        jobqueue.run_repeating(report_stats, interval=STATS_REPORT_INTERVAL, name="stats_report")
 
+    # INITIALIZE DATABASE
+    # create the tables of every shard if they don't exist already. The bot does not start on a database
+    # whose migration failed
+    try:
+        create_all_tables()
+    except (sqlite3.Error, ValueError) as e:
+        log_listener.stop()
+        sys.exit("could not migrate the database: {}".format(e))
+
+    # the "I contacted X Y today!" updates can be committed in groups instead of one commit per reply
+    global last_contact_buffer
+    if LAST_CONTACT_BUFFER:
+        last_contact_buffer = LastContactBuffer(db_shards, flush_interval=LAST_CONTACT_FLUSH_MS / 1000,
+                                                flush_rows=LAST_CONTACT_FLUSH_ROWS,
+                                                max_pending=LAST_CONTACT_MAX_PENDING,
+                                                submit_timeout=DB_SUBMIT_TIMEOUT)
+        last_contact_buffer.start()
+
+    # register all handlers with the dispatcher
+    add_handlers(dispatcher)
+
+    # the due contacts of the bucketed reminders can be computed by worker processes, which only pays off with
+    # more than one core
+    global reminder_pool
+    if REMINDER_PROCESSES and SCHEDULER_MODE == "bucketed" and (os.cpu_count() or 1) < 2:
+        logger.warning("REMINDER_PROCESSES needs more than one CPU, reminders are computed in the bot process")
+    elif REMINDER_PROCESSES and SCHEDULER_MODE == "bucketed":
+        try:
+            reminder_pool = start_reminder_pool(REMINDER_PROCESSES)
+            logger.info("Started reminder workers", extra={"processes": REMINDER_PROCESSES})
+        except (OSError, concurrent.futures.BrokenExecutor) as e:
+            logger.error("Could not start the reminder workers, reminders are computed in the bot process",
+                         extra={"error": str(e)})
+    # in wheel mode a single job reminds the users whose reminder time has come
+    if SCHEDULER_MODE == "wheel":
+        jobqueue.run_repeating(reminder_wheel_tick, interval=1, first=1, name="reminder_wheel")
+    # add a jobs to the job queue for each registered user while the bot already serves updates
+    start_scheduling_reminders(jobqueue)
+    # rebuild the due contacts of the day every night
+    schedule_due_today(jobqueue)
 
-main()
+    # START BOT
+    logger.info("Starting bot")
+    if SERVING_MODE == "webhook":
+        serve_webhook(updater)
+    else:
+        updater.start_polling()
+        logger.info("Bot is now polling for updates")
+        updater.idle()
+    outbound_queue.stop(timeout=30)
+    if reminder_pool is not None:
+        reminder_pool.shutdown()
+    if metrics_server is not None:
+        metrics_server.stop()
+    # the handlers are stopped, so the buffer can commit its last updates before the databases are closed
+    if last_contact_buffer is not None:
+        last_contact_buffer.stop(timeout=30)
+    close_databases()
+    log_listener.stop()
+
+
+# command line interface for offline tools, e.g.
+# python contact_reminder.py import --chat-id 123456 contacts.csv
+# python contact_reminder.py export --chat-id 123456 --output contacts.csv
+# python contact_reminder.py rebalance --to-shards 4
+def cli(argv):
+    parser = argparse.ArgumentParser(description="offline tools of the contact reminder bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="import the contacts of a chat from a CSV or vCard file")
+    import_parser.add_argument("--chat-id", type=int, required=True, help="chat of the user to import for")
+    import_parser.add_argument("--format", choices=["csv", "vcard"], help="default: guessed from the file name")
+    import_parser.add_argument("file")
+    export_parser = commands.add_parser("export", help="export the contacts of a chat as CSV or JSON Lines")
+    export_parser.add_argument("--chat-id", type=int, required=True, help="chat of the user to export")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export_parser.add_argument("--output", help="default: standard output")
+    rebalance_parser = commands.add_parser("rebalance", help="spread the users over another number of database "
+                                                             "shards, the bot must be stopped")
+    rebalance_parser.add_argument("--from-shards", type=int, default=DB_SHARDS, help="default: DB_SHARDS")
+    rebalance_parser.add_argument("--to-shards", type=int, required=True)
+    args = parser.parse_args(argv)
+
+    log_listener = setup_logging()
+    if args.command == "rebalance":
+        try:
+            if args.from_shards < 1 or args.to_shards < 1:
+                sys.exit("the number of shards must be at least 1")
+            result = rebalance(args.from_shards, args.to_shards)
+        except (OSError, RuntimeError, sqlite3.Error, ValueError) as e:
+            sys.exit("could not rebalance: {}".format(e))
+        finally:
+            log_listener.stop()
+        print("moved {users} users and {contacts} contacts in {seconds:.1f}s".format(**result))
+        print("set DB_SHARDS = {} in {}, the old databases are kept as {}".format(args.to_shards, CONF_NAME,
+                                                                                  ", ".join(result["backups"])))
+        return
+    try:
+        create_all_tables()
+    except (sqlite3.Error, ValueError) as e:
+        log_listener.stop()
+        sys.exit("could not migrate the database: {}".format(e))
+    try:
+        user = lookup_user(args.chat_id)
+        if user is None:
+            sys.exit("chat {} is not registered".format(args.chat_id))
+        if args.command == "import":
+            file_format = args.format or import_format(args.file)
+            if file_format is None:
+                sys.exit("unknown file format, use --format")
+            with open(args.file, encoding="utf-8-sig", newline="") as text_file:
+                result = import_file(args.chat_id, user.user_id, text_file, file_format)
+            print("imported {imported} of {read} contacts in {seconds:.2f}s ({rows_per_second:.0f} rows/s), "
+                  "{duplicates} duplicates, {invalid} invalid".format(**result))
+        elif args.command == "export":
+            out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+            try:
+                count = db_for(args.chat_id).read(export_contacts, user.user_id, out, args.format,
+                                                  batch=True).result()
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            print("exported {} contacts".format(count), file=sys.stderr)
+    finally:
+        close_databases()
+        log_listener.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+    else:
+        main()